@@ -0,0 +1,215 @@
+"""NumPy decode and NMS for the raw output of a YOLOv7 export without NMS in the graph
+
+Only NumPy is required; numba is used for the NMS inner loop when installed. Export the model without --end2end and
+--include-nms: with --grid the 'output' tensor is already decoded to (batch, anchors, 5 + classes), without it the
+per-level maps are decoded by decode().
+
+Usage:
+    from nms import non_max_suppression
+    det = non_max_suppression(output, conf_thres=0.25, iou_thres=0.45)[0]  # (n, 6) [xyxy, conf, cls]
+
+Benchmark against utils.general.non_max_suppression (needs torch and the repository):
+    python nms.py --batch-size 16
+"""
+
+import time
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # NumPy inner loop
+    njit = None
+
+ANCHORS = ((12, 16, 19, 36, 40, 28), (36, 75, 76, 55, 72, 146), (142, 110, 192, 243, 459, 401))  # yolov7.yaml P3-P5
+STRIDES = (8, 16, 32)
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def xywh2xyxy(x):
+    # Convert nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
+    y = np.copy(x)
+    y[:, 0] = x[:, 0] - x[:, 2] / 2  # top left x
+    y[:, 1] = x[:, 1] - x[:, 3] / 2  # top left y
+    y[:, 2] = x[:, 0] + x[:, 2] / 2  # bottom right x
+    y[:, 3] = x[:, 1] + x[:, 3] / 2  # bottom right y
+    return y
+
+
+def decode(outputs, anchors=ANCHORS, strides=STRIDES):
+    # Decode the per-level maps of an export without --grid, (bs, na, ny, nx, no) logits each, to (bs, n, no)
+    z = []
+    for x, a, s in zip(outputs, anchors, strides):
+        bs, na, ny, nx, no = x.shape
+        yv, xv = np.meshgrid(np.arange(ny), np.arange(nx), indexing='ij')
+        grid = np.stack((xv, yv), 2).reshape(1, 1, ny, nx, 2).astype(np.float32)
+        y = sigmoid(x.astype(np.float32))
+        y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + grid) * s  # xy
+        y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * np.asarray(a, dtype=np.float32).reshape(1, na, 1, 1, 2)  # wh
+        z.append(y.reshape(bs, -1, no))
+    return np.concatenate(z, 1)
+
+
+def _nms_sorted(boxes, iou_thres):
+    # Greedy NMS over xyxy boxes sorted by decreasing score, compiled by numba
+    n = boxes.shape[0]
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    suppressed = np.zeros(n, dtype=np.bool_)
+    keep = np.empty(n, dtype=np.int64)
+    m = 0
+    for i in range(n):
+        if suppressed[i]:
+            continue
+        keep[m] = i
+        m += 1
+        for j in range(i + 1, n):
+            if suppressed[j]:
+                continue
+            w = min(boxes[i, 2], boxes[j, 2]) - max(boxes[i, 0], boxes[j, 0])
+            h = min(boxes[i, 3], boxes[j, 3]) - max(boxes[i, 1], boxes[j, 1])
+            if w > 0 and h > 0:
+                inter = w * h
+                if inter / (area[i] + area[j] - inter) > iou_thres:
+                    suppressed[j] = True
+    return keep[:m]
+
+
+if njit is not None:
+    _nms_sorted = njit(cache=True)(_nms_sorted)
+
+
+def nms(boxes, scores, iou_thres, use_numba=True, max_matrix=2048):
+    # Indices of the xyxy boxes kept by greedy NMS, by decreasing score, as torchvision.ops.nms()
+    # Without numba, up to max_matrix boxes use a full IoU matrix and more boxes a loop over the kept ones
+    order = np.argsort(-scores, kind='stable')
+    b = boxes[order]
+    if njit is not None and use_numba:
+        return order[_nms_sorted(b, iou_thres)]
+
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    if len(b) <= max_matrix:  # IoU matrix, the greedy pass only clears rows of kept boxes
+        w = np.minimum(b[:, None, 2], b[:, 2]) - np.maximum(b[:, None, 0], b[:, 0])
+        h = np.minimum(b[:, None, 3], b[:, 3]) - np.maximum(b[:, None, 1], b[:, 1])
+        inter = np.maximum(w, 0) * np.maximum(h, 0)
+        with np.errstate(invalid='ignore'):  # NaN IoU of empty boxes never suppresses, as torchvision
+            over = np.triu(inter / (area[:, None] + area - inter) > iou_thres, 1)  # later boxes each box suppresses
+        keep = np.ones(len(b), dtype=bool)
+        for k in range(len(b)):
+            if keep[k]:
+                keep &= ~over[k]
+        return order[keep]
+
+    keep = []
+    i = np.arange(len(b))
+    while i.size:
+        k, i = i[0], i[1:]  # highest remaining score, rest
+        keep.append(k)
+        w = np.minimum(b[k, 2], b[i, 2]) - np.maximum(b[k, 0], b[i, 0])
+        h = np.minimum(b[k, 3], b[i, 3]) - np.maximum(b[k, 1], b[i, 1])
+        inter = np.maximum(w, 0) * np.maximum(h, 0)
+        with np.errstate(invalid='ignore'):
+            i = i[~(inter / (area[k] + area[i] - inter) > iou_thres)]
+    return order[np.array(keep, dtype=np.int64)]
+
+
+def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
+                        max_det=300, use_numba=True):
+    """Runs Non-Maximum Suppression (NMS) on inference results, as utils.general.non_max_suppression()
+
+    Returns:
+         list of detections, on (n,6) array per image [xyxy, conf, cls]
+    """
+
+    nc = prediction.shape[2] - 5  # number of classes
+    xc = prediction[..., 4] > conf_thres  # candidates
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes into nms()
+    multi_label &= nc > 1  # multiple labels per box
+
+    output = [np.zeros((0, 6), dtype=np.float32)] * prediction.shape[0]
+    for xi, x in enumerate(prediction):  # image index, image inference
+        x = x[xc[xi]].astype(np.float32)  # confidence
+        if not x.shape[0]:
+            continue
+
+        # Compute conf
+        if nc == 1:
+            x[:, 5:] = x[:, 4:5]  # for models with one class, cls_conf is always 0.5
+        else:
+            x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+        # Detections matrix nx6 (xyxy, conf, cls)
+        box = xywh2xyxy(x[:, :4])
+        if multi_label:
+            i, j = (x[:, 5:] > conf_thres).nonzero()
+            x = np.concatenate((box[i], x[i, j + 5, None], j[:, None].astype(np.float32)), 1)
+        else:  # best class only
+            j = x[:, 5:].argmax(1)[:, None]
+            conf = np.take_along_axis(x[:, 5:], j, 1)
+            x = np.concatenate((box, conf, j.astype(np.float32)), 1)[conf[:, 0] > conf_thres]
+
+        # Filter by class
+        if classes is not None:
+            x = x[(x[:, 5:6] == np.array(classes)).any(1)]
+
+        n = x.shape[0]  # number of boxes
+        if not n:
+            continue
+        elif n > max_nms:  # excess boxes
+            x = x[np.argsort(-x[:, 4], kind='stable')[:max_nms]]  # sort by confidence
+
+        # Batched NMS
+        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+        i = nms(x[:, :4] + c, x[:, 4], iou_thres, use_numba)  # boxes offset by class
+        output[xi] = x[i[:max_det]]
+
+    return output
+
+
+def profile(batch_size=16, n=25200, nc=80, conf_thres=0.25, iou_thres=0.45, runs=5):
+    # Time non_max_suppression() here, with and without numba, against utils.general.non_max_suppression()
+    import sys
+    from pathlib import Path
+    import torch
+    sys.path.append(str(Path(__file__).resolve().parents[2]))  # repository root
+    from utils.general import non_max_suppression as non_max_suppression_torch
+
+    rng = np.random.default_rng(0)
+    p = rng.random((batch_size, n, nc + 5), dtype=np.float32)
+    p[..., :2] *= 640  # xy
+    p[..., 2:4] = p[..., 2:4] * 100 + 4  # wh
+    p[..., 4] *= rng.random((batch_size, n)) < 0.01  # objects at 1% of anchors
+    p[..., 5:] = p[..., 5:] ** 64  # peaked class scores
+
+    fs = {'torch': lambda x: [d.numpy() for d in non_max_suppression_torch(torch.from_numpy(x), conf_thres, iou_thres)],
+          'numpy': lambda x: non_max_suppression(x, conf_thres, iou_thres, use_numba=False)}
+    if njit is not None:
+        fs['numba'] = lambda x: non_max_suppression(x, conf_thres, iou_thres)
+    ref = None
+    for k, f in fs.items():
+        f(p.copy())  # warmup, numba compile
+        dt = 0.0
+        for _ in range(runs):
+            x = p.copy()  # predictions are modified in place
+            t = time.time()
+            out = f(x)
+            dt += (time.time() - t) / runs
+        if ref is None:
+            ref = out
+        same = all(a.shape == b.shape and np.allclose(a, b, atol=1e-4) for a, b in zip(out, ref))
+        print(f'{k:>6}: {dt * 1E3:8.1f} ms per batch of {batch_size}, {sum(len(x) for x in out)} detections, '
+              f'matches torch: {same}')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=16, help='images per batch')
+    parser.add_argument('--anchors', type=int, default=25200, help='anchors per image, 25200 at 640')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='object confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
+    opt = parser.parse_args()
+    profile(opt.batch_size, opt.anchors, conf_thres=opt.conf_thres, iou_thres=opt.iou_thres)
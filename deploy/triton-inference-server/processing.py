@@ -1,4 +1,5 @@
 from boundingbox import BoundingBox
+from nms import non_max_suppression
 
 import cv2
 import numpy as np
@@ -28,7 +29,7 @@ def preprocess(img, input_shape, letter_box=True):
 def postprocess(num_dets, det_boxes, det_scores, det_classes, img_w, img_h, input_shape, letter_box=True):
     boxes = det_boxes[0, :num_dets[0][0]] / np.array([input_shape[0], input_shape[1], input_shape[0], input_shape[1]], dtype=np.float32)
     scores = det_scores[0, :num_dets[0][0]]
-    classes = det_classes[0, :num_dets[0][0]].astype(np.int)
+    classes = det_classes[0, :num_dets[0][0]].astype(int)
 
     old_h, old_w = img_h, img_w
     offset_h, offset_w = 0, 0
@@ -43,9 +44,16 @@ def postprocess(num_dets, det_boxes, det_scores, det_classes, img_w, img_h, inpu
     boxes = boxes * np.array([old_w, old_h, old_w, old_h], dtype=np.float32)
     if letter_box:
         boxes -= np.array([offset_w, offset_h, offset_w, offset_h], dtype=np.float32)
-    boxes = boxes.astype(np.int)
+    boxes = boxes.astype(int)
 
     detected_objects = []
     for box, score, label in zip(boxes, scores, classes):
         detected_objects.append(BoundingBox(label, score, box[0], box[2], box[1], box[3], img_w, img_h))
     return detected_objects
+
+
+def postprocess_output(output, img_w, img_h, input_shape, conf_thres=0.25, iou_thres=0.45, letter_box=True):
+    # Same as postprocess() for the 'output' tensor of a model exported without NMS (--grid, no --end2end)
+    det = non_max_suppression(output[:1], conf_thres, iou_thres)[0]
+    return postprocess(np.array([[len(det)]]), det[None, :, :4], det[None, :, 4], det[None, :, 5],
+                       img_w, img_h, input_shape, letter_box)
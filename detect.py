@@ -1,20 +1,34 @@
 import argparse
 import time
 from pathlib import Path
+from queue import Queue
+from threading import Event, Thread
 
 import cv2
+import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 from numpy import random
 
 from models.experimental import attempt_load
-from utils.datasets import LoadStreams, LoadImages
+from models.yolo import Detect, IDetect
+from utils.datasets import LoadStreams, LoadImages, StreamIngest, InputBuffer
 from utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, apply_classifier, \
     scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path
 from utils.plots import plot_one_box
 from utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel
 
 
+def collate(batch):
+    # Stack letterboxed (t, img, meta) items into one batch, padding bottom-right to the largest height and width
+    h = max(x[1].shape[1] for x in batch)
+    w = max(x[1].shape[2] for x in batch)
+    img = np.full((len(batch), 3, h, w), 114, dtype=np.uint8)
+    for i, (_, im, _) in enumerate(batch):
+        img[i, :, :im.shape[1], :im.shape[2]] = im
+    return batch[0][0], torch.from_numpy(img), [x[2] for x in batch]
+
+
 def detect(save_img=False):
     source, weights, view_img, save_txt, imgsz, trace = opt.source, opt.weights, opt.view_img, opt.save_txt, opt.img_size, not opt.no_trace
     save_img = not opt.nosave and not source.endswith('.txt')  # save inference images
@@ -38,6 +52,10 @@ def detect(save_img=False):
     if trace:
         model = TracedModel(model, device, opt.img_size)
 
+    for m in model.modules():
+        if isinstance(m, (Detect, IDetect)):  # pre-NMS top-k in the detection head
+            m.pre_nms_topk, m.pre_nms_conf = opt.pre_nms_topk, opt.conf_thres
+
     if half:
         model.half()  # to FP16
 
@@ -48,13 +66,29 @@ def detect(save_img=False):
         modelc.load_state_dict(torch.load('weights/resnet101.pt', map_location=device)['model']).to(device).eval()
 
     # Set Dataloader
-    vid_path, vid_writer = None, None
     if webcam:
         view_img = check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride)
+        if opt.zero_copy:
+            print('WARNING: --zero-copy applies to file sources only, streams are letterboxed by their reader threads')
+        if opt.ingest:  # per-stream decode workers, micro-batches with a deadline, reconnects
+            dataset = StreamIngest(source, img_size=imgsz, stride=stride, batch_size=opt.stream_batch,
+                                   max_wait=opt.max_wait / 1E3,
+                                   queue_size=opt.stream_queue if opt.stream_policy == 'all' else 1)
+        else:
+            dataset = LoadStreams(source, img_size=imgsz, stride=stride, policy=opt.stream_policy,
+                                  queue_size=opt.stream_queue, frame_stride=opt.frame_stride)
+    else:
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, prefetch=opt.prefetch, raw=opt.zero_copy)
+
+    # HighGUI is not thread-safe: windows are shown and keys polled only on this thread, the reader thread stays quiet
+    if webcam:
+        dataset.poll_keys = False
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride)
+        dataset.verbose = False  # video progress is printed with the results of each frame
+
+    # Letterbox file sources straight into reused (pinned) input buffers, one per batch in flight
+    inp = InputBuffer(device, half, imgsz, stride, slots=opt.queue_depth + 2) if opt.zero_copy and not webcam else None
 
     # Get names and colors
     names = model.module.names if hasattr(model, 'module') else model.names
@@ -66,101 +100,228 @@ def detect(save_img=False):
     old_img_w = old_img_h = imgsz
     old_img_b = 1
 
+    # Pipeline: reader thread -> inference (this thread) -> postprocess/writer thread, joined by bounded queues.
+    # Annotated frames to view come back to this thread through q_view, unbounded so postprocess() never waits on it
+    q_in, q_out, q_view = Queue(maxsize=opt.queue_depth), Queue(maxsize=opt.queue_depth), Queue()
+    stop = Event()  # 'q' pressed in a stream window
+    dt = {'read': [], 'inference': [], 'nms': [], 'postprocess': [], 'latency': []}  # seconds per batch
+    errors = []  # exceptions raised in the reader and postprocess threads
+
+    def print_ingest():
+        for x in dataset.info():
+            print(f"{x['source']}: {x['fps']:.1f} FPS, decode {x['decode_ms']:.1f}ms, queue {x['queue']}, "
+                  f"{x['dropped']} dropped, {x['reconnects']} reconnects")
+    streams = {}  # per stream source: frames, dropped, last sequence number, latencies
+
+    def read():
+        # Decode and letterbox ahead of inference, recording the dataset state each image needs downstream. Items are
+        # (time, uint8 batch tensor, [(path, print prefix, im0, vid_cap, mode, frame, letterboxed shape, stamp), ...])
+        # where stamp is the (sequence number, capture time) of stream frames and None for files
+        try:
+            it, batch, t_info = iter(dataset), [], time.time()
+            while not stop.is_set():
+                if hasattr(dataset, 'info') and time.time() - t_info > opt.stats_interval:  # StreamIngest stats
+                    print_ingest()
+                    t_info = time.time()
+                t = time.time()
+                try:
+                    path, img, im0s, vid_cap = next(it)
+                except StopIteration:
+                    break
+                if webcam:  # one batch of all streams, or of the ready streams with --ingest
+                    streams = dataset.indices if opt.ingest else range(len(path))
+                    meta = [(x, '%g: ' % s, im0s[i].copy(), None, dataset.mode, dataset.count, img.shape[2:],
+                             (dataset.seqs[i], dataset.timestamps[i])) for i, (x, s) in enumerate(zip(path, streams))]
+                    dt['read'].append(time.time() - t)
+                    q_in.put((t, torch.from_numpy(img), meta))
+                    continue
+                frame = getattr(dataset, 'frame', 0)
+                shape = img.shape[1:] if img is not None else None  # set by InputBuffer.load() if raw
+                batch.append((t, img, (path, dataset.progress, im0s, vid_cap, dataset.mode, frame, shape, None)))
+                if len(batch) == opt.batch_size:
+                    q_in.put(stack(batch))
+                    batch = []
+            if batch:
+                q_in.put(stack(batch))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if stop.is_set() and hasattr(dataset, 'running'):
+                dataset.running = False  # StreamIngest workers
+            q_in.put(None)
+
+    def stack(batch):
+        # One batch item from letterboxed images, or from raw images loaded into an InputBuffer slot
+        if inp:
+            slot, shapes = inp.load([x[2][2] for x in batch])
+            item = batch[0][0], slot, [x[2][:6] + (shape,) + x[2][7:] for x, shape in zip(batch, shapes)]
+        else:
+            item = collate(batch)
+        dt['read'].append(time.time() - batch[0][0])
+        return item
+
+    def postprocess():
+        # Rescale, print, draw and write detections while the next items are read and inferred
+        vid_path, vid_writer = None, None
+        x = None
+        try:
+            while True:
+                x = q_out.get()
+                if x is None:
+                    break
+                t0_, pred, meta, (t1, t2, t3) = x
+                t = time.time()
+                for det, (p, s, im0, vid_cap, mode, frame, shape, stamp) in zip(pred, meta):  # detections per image
+                    p = Path(p)  # to Path
+                    save_path = str(save_dir / p.name)  # img.jpg
+                    txt_path = str(save_dir / 'labels' / p.stem) + ('' if mode == 'image' else f'_{frame}')  # img.txt
+                    gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+                    if len(det):
+                        # Rescale boxes from img_size to im0 size, batch padding is bottom-right so shape is unpadded
+                        det[:, :4] = scale_coords(shape, det[:, :4], im0.shape).round()
+
+                        # Print results
+                        for c in det[:, -1].unique():
+                            n = (det[:, -1] == c).sum()  # detections per class
+                            s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+
+                        # Write results
+                        for *xyxy, conf, cls in reversed(det):
+                            if save_txt:  # Write to file
+                                xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
+                                line = (cls, *xywh, conf) if opt.save_conf else (cls, *xywh)  # label format
+                                with open(txt_path + '.txt', 'a') as f:
+                                    f.write(('%g ' * len(line)).rstrip() % line + '\n')
+
+                            if save_img or view_img:  # Add bbox to image
+                                label = f'{names[int(cls)]} {conf:.2f}'
+                                plot_one_box(xyxy, im0, label=label, color=colors[int(cls)], line_thickness=1)
+
+                    # Print time (inference + NMS)
+                    print(f'{s}Done. ({(1E3 * (t2 - t1)):.1f}ms) Inference, ({(1E3 * (t3 - t2)):.1f}ms) NMS')
+
+                    # Stream results, shown by the main thread
+                    if view_img:
+                        q_view.put((str(p), im0))
+
+                    # Save results (image with detections)
+                    if save_img:
+                        if mode == 'image':
+                            cv2.imwrite(save_path, im0)
+                            print(f" The image with the result is saved in: {save_path}")
+                        else:  # 'video' or 'stream'
+                            if vid_path != save_path:  # new video
+                                vid_path = save_path
+                                if isinstance(vid_writer, cv2.VideoWriter):
+                                    vid_writer.release()  # release previous video writer
+                                if vid_cap:  # video
+                                    fps = vid_cap.get(cv2.CAP_PROP_FPS)
+                                    w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                                    h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                                else:  # stream
+                                    fps, w, h = 30, im0.shape[1], im0.shape[0]
+                                    save_path += '.mp4'
+                                vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                            vid_writer.write(im0)
+
+                    # Stream frame latency (capture to written) and frames dropped since the last one
+                    if stamp:
+                        seq, ts = stamp
+                        st = streams.setdefault(str(p), {'frames': 0, 'dropped': 0, 'seq': seq - 1, 'latency': []})
+                        st['frames'] += 1
+                        st['dropped'] += max(seq - st['seq'] - 1, 0)
+                        st['seq'] = seq
+                        st['latency'].append(time.time() - ts)
+                dt['postprocess'].append(time.time() - t)
+                dt['latency'].append(time.time() - t0_)
+        except Exception as e:
+            errors.append(e)
+            while x is not None:  # keep draining so the inference stage never blocks on a full queue
+                x = q_out.get()
+        finally:
+            if isinstance(vid_writer, cv2.VideoWriter):
+                vid_writer.release()
+
+    def show():
+        # Display the annotated frames postprocess() queued, on the main thread
+        while not q_view.empty():
+            name, im0 = q_view.get()
+            if stop.is_set():  # windows closed
+                continue
+            cv2.imshow(name, im0)
+            if cv2.waitKey(1) == ord('q') and webcam:  # 1 millisecond, q to quit streams
+                cv2.destroyAllWindows()
+                stop.set()
+
     t0 = time.time()
-    for path, img, im0s, vid_cap in dataset:
-        img = torch.from_numpy(img).to(device)
-        img = img.half() if half else img.float()  # uint8 to fp16/32
-        img /= 255.0  # 0 - 255 to 0.0 - 1.0
-        if img.ndimension() == 3:
-            img = img.unsqueeze(0)
-
-        # Warmup
-        if device.type != 'cpu' and (old_img_b != img.shape[0] or old_img_h != img.shape[2] or old_img_w != img.shape[3]):
-            old_img_b = img.shape[0]
-            old_img_h = img.shape[2]
-            old_img_w = img.shape[3]
-            for i in range(3):
-                model(img, augment=opt.augment)[0]
-
-        # Inference
-        t1 = time_synchronized()
-        with torch.no_grad():   # Calculating gradients would cause a GPU memory leak
-            pred = model(img, augment=opt.augment)[0]
-        t2 = time_synchronized()
-
-        # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
-        t3 = time_synchronized()
-
-        # Apply Classifier
-        if classify:
-            pred = apply_classifier(pred, modelc, img, im0s)
-
-        # Process detections
-        for i, det in enumerate(pred):  # detections per image
-            if webcam:  # batch_size >= 1
-                p, s, im0, frame = path[i], '%g: ' % i, im0s[i].copy(), dataset.count
+    threads = [Thread(target=read, daemon=True), Thread(target=postprocess, daemon=True)]
+    for thread in threads:
+        thread.start()
+    seen = 0  # images
+    try:
+        while True:
+            show()
+            x = q_in.get()
+            if x is None:
+                break
+            t, img, meta = x
+            if inp:  # normalized in place on the device
+                img = inp.to_device(*img)
             else:
-                p, s, im0, frame = path, '', im0s, getattr(dataset, 'frame', 0)
-
-            p = Path(p)  # to Path
-            save_path = str(save_dir / p.name)  # img.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # img.txt
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-            if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
-
-                # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if opt.save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or view_img:  # Add bbox to image
-                        label = f'{names[int(cls)]} {conf:.2f}'
-                        plot_one_box(xyxy, im0, label=label, color=colors[int(cls)], line_thickness=1)
-
-            # Print time (inference + NMS)
-            print(f'{s}Done. ({(1E3 * (t2 - t1)):.1f}ms) Inference, ({(1E3 * (t3 - t2)):.1f}ms) NMS')
-
-            # Stream results
-            if view_img:
-                cv2.imshow(str(p), im0)
-                cv2.waitKey(1)  # 1 millisecond
-
-            # Save results (image with detections)
-            if save_img:
-                if dataset.mode == 'image':
-                    cv2.imwrite(save_path, im0)
-                    print(f" The image with the result is saved in: {save_path}")
-                else:  # 'video' or 'stream'
-                    if vid_path != save_path:  # new video
-                        vid_path = save_path
-                        if isinstance(vid_writer, cv2.VideoWriter):
-                            vid_writer.release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, im0.shape[1], im0.shape[0]
-                            save_path += '.mp4'
-                        vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer.write(im0)
+                img = img.to(device)
+                img = img.half() if half else img.float()  # uint8 to fp16/32
+                img /= 255.0  # 0 - 255 to 0.0 - 1.0
+            if img.ndimension() == 3:
+                img = img.unsqueeze(0)
+
+            # Warmup
+            if device.type != 'cpu' and (old_img_b != img.shape[0] or old_img_h != img.shape[2] or old_img_w != img.shape[3]):
+                old_img_b = img.shape[0]
+                old_img_h = img.shape[2]
+                old_img_w = img.shape[3]
+                for i in range(3):
+                    model(img, augment=opt.augment)[0]
+
+            # Inference
+            t1 = time_synchronized()
+            with torch.no_grad():   # Calculating gradients would cause a GPU memory leak
+                pred = model(img, augment=opt.augment)[0]
+            t2 = time_synchronized()
+
+            # Apply NMS
+            pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms,
+                                       mode=opt.nms_mode)
+            t3 = time_synchronized()
+
+            # Apply Classifier
+            if classify:
+                pred = apply_classifier(pred, modelc, img, [m[2] for m in meta])
+
+            dt['inference'].append(t2 - t1)
+            dt['nms'].append(t3 - t2)
+            seen += len(pred)
+            q_out.put((t, [det.cpu() for det in pred], meta, (t1, t2, t3)))
+    finally:
+        q_out.put(None)
+        threads[1].join()
+        show()
+    if errors:
+        raise errors[0]
 
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         #print(f"Results saved to {save_dir}{s}")
 
-    print(f'Done. ({time.time() - t0:.3f}s)')
+    t = time.time() - t0
+    print(f'Done. ({t:.3f}s)')
+    ms = ', '.join(f'{k} {1E3 * sum(v) / max(len(v), 1):.1f}ms' for k, v in dt.items())
+    print(f'Pipeline: {seen} images at {seen / t:.1f} FPS (queue depth {opt.queue_depth}), mean per batch: {ms}')
+    if hasattr(dataset, 'info'):
+        print_ingest()
+    for k, v in streams.items():
+        lat = np.array(v['latency']) * 1E3
+        print(f"{k}: {v['frames']} frames, {v['dropped']} dropped ({opt.stream_policy}), "
+              f"latency {lat.mean():.1f}ms mean, {np.percentile(lat, 95):.1f}ms p95, {lat.max():.1f}ms max")
 
 
 if __name__ == '__main__':
@@ -170,6 +331,7 @@ if __name__ == '__main__':
     parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
     parser.add_argument('--conf-thres', type=float, default=0.25, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS')
+    parser.add_argument('--pre-nms-topk', type=int, default=0, help='anchors per level decoded for NMS, 0 for all')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--view-img', action='store_true', help='display results')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
@@ -177,12 +339,26 @@ if __name__ == '__main__':
     parser.add_argument('--nosave', action='store_true', help='do not save images/videos')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --class 0, or --class 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
+    parser.add_argument('--nms-mode', default='nms', choices=['nms', 'merge', 'soft'],
+                        help='standard, merge or Soft-NMS (soft ignores --iou-thres)')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
     parser.add_argument('--update', action='store_true', help='update all models')
     parser.add_argument('--project', default='runs/detect', help='save results to project/name')
     parser.add_argument('--name', default='exp', help='save results to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--no-trace', action='store_true', help='don`t trace model')
+    parser.add_argument('--batch-size', type=int, default=1, help='images per forward pass for file/folder sources')
+    parser.add_argument('--prefetch', type=int, default=4, help='file/folder frames decoded ahead in background threads')
+    parser.add_argument('--stream-policy', default='latest', choices=['latest', 'all', 'stride'],
+                        help='stream frames to process: newest, every frame (drop-oldest queue) or every --frame-stride')
+    parser.add_argument('--stream-queue', type=int, default=8, help='frames queued per stream with --stream-policy all')
+    parser.add_argument('--frame-stride', type=int, default=4, help='process every n-th frame with --stream-policy stride')
+    parser.add_argument('--ingest', action='store_true', help='decode streams in per-stream workers into micro-batches')
+    parser.add_argument('--stream-batch', type=int, default=0, help='max streams per --ingest micro-batch, 0 for all')
+    parser.add_argument('--max-wait', type=float, default=10.0, help='--ingest micro-batch deadline (ms)')
+    parser.add_argument('--stats-interval', type=float, default=10.0, help='seconds between --ingest stream stats')
+    parser.add_argument('--zero-copy', action='store_true', help='letterbox file sources into reused pinned buffers')
+    parser.add_argument('--queue-depth', type=int, default=4, help='max items queued between read, inference and write')
     opt = parser.parse_args()
     print(opt)
     #check_requirements(exclude=('pycocotools', 'thop'))
@@ -26,6 +26,8 @@ class Detect(nn.Module):
     end2end = False
     include_nms = False
     concat = False
+    pre_nms_topk = 0  # inference: decode only the top-k anchors by objectness per level, 0 for all
+    pre_nms_conf = 0.0  # inference: with pre_nms_topk, zero objectness not above this threshold
 
     def __init__(self, nc=80, anchors=(), ch=()):  # detection layer
         super(Detect, self).__init__()
@@ -49,6 +51,9 @@ class Detect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
+                if self.pre_nms_topk and not torch.onnx.is_in_onnx_export():
+                    z.append(self.decode_topk(i, x[i]))
+                    continue
                 if self.grid[i].shape[2:4] != x[i].shape[2:4]:
                     self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
                 y = x[i].sigmoid()
@@ -93,6 +98,19 @@ class Detect(nn.Module):
         box @= convert_matrix                          
         return (box, score)
 
+    def decode_topk(self, i, x):
+        # Decode the pre_nms_topk anchors of level i with the highest objectness, x(bs,na,ny,nx,no) to y(bs,k,no)
+        bs, na, ny, nx, no = x.shape
+        x = x.view(bs, -1, no)
+        j = x[..., 4].topk(min(self.pre_nms_topk, x.shape[1]), 1)[1]  # anchor indices, by decreasing objectness
+        y = x.gather(1, j[..., None].expand(-1, -1, no)).sigmoid()
+        grid = torch.stack((j % nx, j // nx % ny), 2).to(y.dtype)  # grid cell xy
+        y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + grid) * self.stride[i]  # xy
+        y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i].view(na, 2)[j // (nx * ny)]  # wh
+        if self.pre_nms_conf:
+            y[..., 4] *= y[..., 4] > self.pre_nms_conf  # zeroed objectness is dropped by NMS
+        return y
+
 
 class IDetect(nn.Module):
     stride = None  # strides computed during build
@@ -100,6 +118,8 @@ class IDetect(nn.Module):
     end2end = False
     include_nms = False
     concat = False
+    pre_nms_topk = 0  # inference: decode only the top-k anchors by objectness per level, 0 for all
+    pre_nms_conf = 0.0  # inference: with pre_nms_topk, zero objectness not above this threshold
 
     def __init__(self, nc=80, anchors=(), ch=()):  # detection layer
         super(IDetect, self).__init__()
@@ -127,6 +147,9 @@ class IDetect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
+                if self.pre_nms_topk and not torch.onnx.is_in_onnx_export():
+                    z.append(self.decode_topk(i, x[i]))
+                    continue
                 if self.grid[i].shape[2:4] != x[i].shape[2:4]:
                     self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
 
@@ -147,6 +170,9 @@ class IDetect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
+                if self.pre_nms_topk and not torch.onnx.is_in_onnx_export():
+                    z.append(self.decode_topk(i, x[i]))
+                    continue
                 if self.grid[i].shape[2:4] != x[i].shape[2:4]:
                     self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
 
@@ -206,6 +232,8 @@ class IDetect(nn.Module):
         box @= convert_matrix                          
         return (box, score)
 
+    decode_topk = Detect.decode_topk
+
 
 class IKeypoint(nn.Module):
     stride = None  # strides computed during build
@@ -10,9 +10,11 @@ import yaml
 from tqdm import tqdm
 
 from models.experimental import attempt_load
+from models.yolo import Detect, IDetect
 from utils.datasets import create_dataloader
 from utils.general import coco80_to_coco91_class, check_dataset, check_file, check_img_size, check_requirements, \
-    box_iou, non_max_suppression, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, increment_path, colorstr
+    box_iou, non_max_suppression, non_max_suppression_batched, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, \
+    increment_path, colorstr
 from utils.metrics import ap_per_class, ConfusionMatrix
 from utils.plots import plot_images, output_to_target, plot_study_txt
 from utils.torch_utils import select_device, time_synchronized, TracedModel
@@ -40,7 +42,10 @@ def test(data,
          half_precision=True,
          trace=False,
          is_coco=False,
-         v5_metric=False):
+         v5_metric=False,
+         pre_nms_topk=0,
+         nms_mode='nms',
+         nms_batched=False):
     # Initialize/load model and set device
     training = model is not None
     if training:  # called by train.py
@@ -62,6 +67,10 @@ def test(data,
         if trace:
             model = TracedModel(model, device, imgsz)
 
+        for m in model.modules():
+            if isinstance(m, (Detect, IDetect)):  # pre-NMS top-k in the detection head
+                m.pre_nms_topk, m.pre_nms_conf = pre_nms_topk, conf_thres
+
     # Half
     half = device.type != 'cpu' and half_precision  # half precision only supported on CUDA
     if half:
@@ -122,7 +131,8 @@ def test(data,
             targets[:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
             lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
             t = time_synchronized()
-            out = non_max_suppression(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True)
+            nms = non_max_suppression_batched if nms_batched else non_max_suppression
+            out = nms(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True, mode=nms_mode)
             t1 += time_synchronized() - t
 
         # Statistics per image
@@ -295,6 +305,10 @@ if __name__ == '__main__':
     parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
     parser.add_argument('--conf-thres', type=float, default=0.001, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.65, help='IOU threshold for NMS')
+    parser.add_argument('--nms-mode', default='nms', choices=['nms', 'merge', 'soft'],
+                        help='standard, merge or Soft-NMS (soft ignores --iou-thres)')
+    parser.add_argument('--nms-batched', action='store_true', help='run NMS on the whole batch at once')
+    parser.add_argument('--pre-nms-topk', type=int, default=0, help='anchors per level decoded for NMS, 0 for all')
     parser.add_argument('--task', default='val', help='train, val, test, speed or study')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--single-cls', action='store_true', help='treat as single-class dataset')
@@ -330,7 +344,10 @@ if __name__ == '__main__':
              save_hybrid=opt.save_hybrid,
              save_conf=opt.save_conf,
              trace=not opt.no_trace,
-             v5_metric=opt.v5_metric
+             v5_metric=opt.v5_metric,
+             pre_nms_topk=opt.pre_nms_topk,
+             nms_mode=opt.nms_mode,
+             nms_batched=opt.nms_batched
              )
 
     elif opt.task == 'speed':  # speed benchmarks
@@ -0,0 +1,56 @@
+import numpy as np
+
+from utils.datasets import LRUImageCache, RaggedArray, load_label_arrays, save_label_arrays
+
+
+def test_label_arrays_round_trip(tmp_path):
+    # save_label_arrays() + load_label_arrays() return the per-image labels, shapes and segments they were given
+    rng = np.random.default_rng(0)
+    labels = [rng.random((n, 5), dtype=np.float32) for n in (3, 0, 1, 4)]
+    shapes = [(640, 480), (320, 320), (500, 375), (1280, 720)]
+    segments = [[rng.random((k, 2), dtype=np.float32) for k in (5, 3, 7)], [], [rng.random((4, 2), dtype=np.float32)],
+                []]
+    save_label_arrays(tmp_path, labels, shapes, segments)
+    l, s, seg = load_label_arrays(tmp_path)
+    assert len(l) == len(seg) == len(labels)
+    assert np.array_equal(s, np.array(shapes))
+    for a, b in zip(l, labels):
+        assert np.array_equal(a, b)
+    for a, b in zip(seg, segments):
+        assert len(a) == len(b) and all(np.array_equal(x, y) for x, y in zip(a, b))
+
+
+def test_ragged_array_indexing():
+    # int -> view, slice -> list of views, index array -> reordered RaggedArray over the same data
+    x = RaggedArray(np.arange(10), np.array([0, 2, 2, 7]), np.array([2, 2, 7, 10]))
+    assert np.array_equal(x[2], [2, 3, 4, 5, 6]) and len(x[1]) == 0
+    assert np.shares_memory(x[0], x.data)
+    assert [v.tolist() for v in x[1:3]] == [[], [2, 3, 4, 5, 6]]
+    y = x[np.array([3, 0])]
+    assert len(y) == 2 and y.data is x.data
+    assert [v.tolist() for v in y] == [[7, 8, 9], [0, 1]]
+
+
+def test_lru_image_cache_byte_budget():
+    # Least recently used images are evicted once the cached bytes exceed max_bytes, larger images are not cached
+    cache = LRUImageCache(300)
+    img = lambda: (np.zeros(100, np.uint8), (10, 10), (10, 10))
+    for i in range(3):
+        assert cache.get(i) is None
+        cache.put(i, img())
+    assert cache.get(0) is not None  # 0 becomes most recently used
+    cache.put(3, img())  # evicts 1
+    assert list(cache.cache) == [2, 0, 3] and cache.nbytes == 300
+    cache.put(4, (np.zeros(301, np.uint8), (10, 10), (10, 10)))  # over budget on its own
+    assert 4 not in cache.cache
+    info = cache.info()
+    assert (info['hits'], info['misses'], info['evictions'], info['gb']) == (1, 3, 1, 300 / 1E9)
+
+
+def test_lru_image_cache_split():
+    # create_dataloader() divides the budget between workers, info() sums their counters
+    cache = LRUImageCache(1000)
+    cache.split(4)
+    assert cache.max_bytes == 250 and cache.stats.shape == (4, 4)
+    cache.stats[1, 0], cache.stats[3, 0], cache.stats[2, 1] = 2, 3, 5
+    assert cache.info()['hits'] == 5 and cache.info()['hit_rate'] == 0.5
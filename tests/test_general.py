@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from utils.general import non_max_suppression, non_max_suppression_batched
+
+
+def random_predictions(bs=3, n=400, nc=4, seed=0):
+    # (bs, n, 5 + nc) raw detections with overlapping xywh boxes in a 640x640 image, image 1 without candidates
+    g = torch.Generator().manual_seed(seed)
+    p = torch.rand(bs, n, 5 + nc, generator=g)
+    p[..., :2] *= 640
+    p[..., 2:4] = p[..., 2:4] * 120 + 8
+    p[1, :, 4] = 0.0
+    return p
+
+
+@pytest.mark.parametrize('mode', ['nms', 'merge', 'soft'])
+@pytest.mark.parametrize('multi_label,agnostic', [(False, False), (True, False), (False, True)])
+def test_batched_nms_matches_per_image(mode, multi_label, agnostic):
+    # non_max_suppression_batched() returns the same detections per image as non_max_suppression()
+    p = random_predictions()
+    kw = dict(conf_thres=0.1, iou_thres=0.5, multi_label=multi_label, agnostic=agnostic, mode=mode)
+    a, b = non_max_suppression(p.clone(), **kw), non_max_suppression_batched(p.clone(), **kw)
+    assert len(a) == len(b) == len(p) and len(a[1]) == len(b[1]) == 0
+    for x, y in zip(a, b):
+        assert x.shape == y.shape
+        assert torch.allclose(x, y, atol=1e-4)
+
+
+def test_batched_nms_classes_and_labels():
+    # Class filtering and autolabelling apriori labels are applied per image as in non_max_suppression()
+    p = random_predictions(seed=1)
+    labels = [torch.tensor([[1., 100, 100, 200, 200]]), torch.zeros(0, 5), torch.tensor([[3., 0, 0, 50, 50]])]
+    kw = dict(conf_thres=0.2, iou_thres=0.6, classes=[1, 3], labels=labels)
+    for x, y in zip(non_max_suppression(p.clone(), **kw), non_max_suppression_batched(p.clone(), **kw)):
+        assert x.shape == y.shape
+        assert torch.allclose(x, y, atol=1e-4)
@@ -0,0 +1,79 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from utils.loss import TargetCandidates, ota_cls_cost
+
+ANCHORS = torch.tensor([[12, 16, 19, 36, 40, 28], [36, 75, 76, 55, 72, 146], [142, 110, 192, 243, 459, 401]]).float()
+ANCHORS = ANCHORS.view(3, 3, 2) / torch.tensor([8., 16., 32.]).view(3, 1, 1)  # yolov7 anchors in grid units
+
+
+def expanded_cls_cost(p_cls, p_obj, gt_cls):
+    # Former SimOTA class cost, BCE of the (num_gt, N, nc) repeated predictions against one-hot GT classes
+    num_gt, n, nc = len(gt_cls), *p_cls.shape
+    y = (p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_() *
+         p_obj.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()).sqrt_()
+    gt = F.one_hot(gt_cls, nc).float().unsqueeze(1).repeat(1, n, 1)
+    return F.binary_cross_entropy_with_logits(torch.log(y / (1 - y)), gt, reduction="none").sum(-1)
+
+
+def test_ota_cls_cost_matches_expanded_bce():
+    # ota_cls_cost() equals the one-hot BCE per image and for a (bs, ...) batch of images
+    g = torch.Generator().manual_seed(0)
+    p_cls, p_obj = torch.randn(2, 50, 80, generator=g) * 3, torch.randn(2, 50, 1, generator=g) * 3
+    gt_cls = torch.randint(0, 80, (2, 7), generator=g)
+    cost = ota_cls_cost(p_cls, p_obj, gt_cls)
+    assert cost.shape == (2, 7, 50)
+    for i in range(2):
+        expected = expanded_cls_cost(p_cls[i], p_obj[i], gt_cls[i])
+        assert torch.allclose(ota_cls_cost(p_cls[i], p_obj[i], gt_cls[i]), expected, rtol=1e-4, atol=1e-4)
+        assert torch.allclose(cost[i], expected, rtol=1e-4, atol=1e-4)
+
+
+def repeated_positives(anchors, anchor_t, g, shapes, targets):
+    # Former find_3_positive() (g=0.5) and find_5_positive() (g=1.0), matching the (5, na, nt) repeated targets
+    na, nt = anchors.shape[1], targets.shape[0]  # number of anchors, targets
+    indices, anch = [], []
+    gain = torch.ones(7, device=targets.device).long()  # normalized to gridspace gain
+    ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
+    targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
+    off = torch.tensor([[0, 0], [1, 0], [0, 1], [-1, 0], [0, -1]], device=targets.device).float() * g  # offsets
+    for i, (ny, nx) in enumerate(shapes):
+        gain[2:6] = torch.tensor([nx, ny, nx, ny])  # xyxy gain
+        t = targets * gain
+        if nt:
+            r = t[:, :, 4:6] / anchors[i][:, None]  # wh ratio
+            t = t[torch.max(r, 1. / r).max(2)[0] < anchor_t]  # filter
+            gxy = t[:, 2:4]  # grid xy
+            gxi = gain[[2, 3]] - gxy  # inverse
+            j, k = ((gxy % 1. < g) & (gxy > 1.)).T
+            l, m = ((gxi % 1. < g) & (gxi > 1.)).T
+            j = torch.stack((torch.ones_like(j), j, k, l, m))
+            t = t.repeat((5, 1, 1))[j]
+            offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
+        else:
+            t = targets[0]
+            offsets = 0
+        gi, gj = (t[:, 2:4] - offsets).long().T  # grid xy indices
+        a = t[:, 6].long()  # anchor indices
+        indices.append((t[:, 0].long(), a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1)))
+        anch.append(anchors[i][a])
+    return indices, anch
+
+
+@pytest.mark.parametrize('g', [0.5, 1.0])
+@pytest.mark.parametrize('nt', [0, 1, 40, 1000])
+@pytest.mark.parametrize('shapes', [[(40, 40), (20, 20), (10, 10)], [(32, 48), (16, 24), (8, 12)]])
+def test_target_candidates_match_repeated_targets(g, nt, shapes):
+    # TargetCandidates.positives() returns the former find_*_positive() indices and anchors, in the same order
+    gen = torch.Generator().manual_seed(nt)
+    targets = torch.cat((torch.randint(0, 4, (nt, 1), generator=gen).float(),
+                         torch.randint(0, 80, (nt, 1), generator=gen).float(),
+                         torch.rand(nt, 2, generator=gen), torch.rand(nt, 2, generator=gen) * 0.5 + 0.001), 1)
+    targets[:nt // 8, 2:4] = targets[:nt // 8, 2:4].round()  # boxes centred on the image border
+    indices, anch = TargetCandidates(ANCHORS, 4.0, g=g).positives(shapes, targets)
+    expected_indices, expected_anch = repeated_positives(ANCHORS, 4.0, g, shapes, targets)
+    assert len(indices) == len(anch) == len(expected_indices) == len(shapes)
+    for x, y in zip(indices, expected_indices):
+        assert all(torch.equal(u, v) for u, v in zip(x, y))
+    assert all(torch.equal(x, y) for x, y in zip(anch, expected_anch))
@@ -245,7 +245,12 @@ def train(hyp, opt, device, tb_writer=None):
     dataloader, dataset = create_dataloader(train_path, imgsz, batch_size, gs, opt,
                                             hyp=hyp, augment=True, cache=opt.cache_images, rect=opt.rect, rank=rank,
                                             world_size=opt.world_size, workers=opt.workers,
-                                            image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '))
+                                            image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '),
+                                            cache_workers=opt.cache_workers, mmap_labels=opt.mmap_labels,
+                                            cache_codec=opt.cache_codec, cache_gb=opt.cache_images_gb,
+                                            decode=opt.decode, batch_augment=opt.batch_augment,
+                                            instance_bank=opt.instance_bank, mmap_instances=opt.mmap_instances,
+                                            rect_buckets=opt.rect_buckets)
     mlc = np.concatenate(dataset.labels, 0)[:, 0].max()  # max label class
     nb = len(dataloader)  # number of batches
     assert mlc < nc, 'Label class %g exceeds nc=%g in %s. Possible class labels are 0-%g' % (mlc, nc, opt.data, nc - 1)
@@ -255,7 +260,9 @@ def train(hyp, opt, device, tb_writer=None):
         testloader = create_dataloader(test_path, imgsz_test, batch_size * 2, gs, opt,  # testloader
                                        hyp=hyp, cache=opt.cache_images and not opt.notest, rect=True, rank=-1,
                                        world_size=opt.world_size, workers=opt.workers,
-                                       pad=0.5, prefix=colorstr('val: '))[0]
+                                       pad=0.5, prefix=colorstr('val: '), cache_workers=opt.cache_workers,
+                                       mmap_labels=opt.mmap_labels, cache_codec=opt.cache_codec,
+                                       decode=opt.decode)[0]
 
         if not opt.resume:
             labels = np.concatenate(dataset.labels, 0)
@@ -326,7 +333,7 @@ def train(hyp, opt, device, tb_writer=None):
         # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
 
         mloss = torch.zeros(4, device=device)  # mean losses
-        if rank != -1:
+        if rank != -1 and not opt.rect_buckets:  # AspectRatioBatchSampler sets the epoch of its sampler itself
             dataloader.sampler.set_epoch(epoch)
         pbar = enumerate(dataloader)
         logger.info(('\n' + '%10s' * 8) % ('Epoch', 'gpu_mem', 'box', 'obj', 'cls', 'total', 'labels', 'img_size'))
@@ -439,6 +446,12 @@ def train(hyp, opt, device, tb_writer=None):
                     tb_writer.add_scalar(tag, x, epoch)  # tensorboard
                 if wandb_logger.wandb:
                     wandb_logger.log({tag: x})  # W&B
+            if dataset.img_lru:  # LRU image cache counters
+                c = dataset.img_lru.info()
+                logger.info(f"Image cache: {c['hit_rate']:.1%} hits, {c['evictions']} evictions, {c['gb']:.1f}GB")
+                for k in 'hit_rate', 'evictions', 'gb':
+                    if tb_writer:
+                        tb_writer.add_scalar(f'x/cache_{k}', c[k], epoch)
 
             # Update best mAP
             fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
@@ -531,13 +544,24 @@ if __name__ == '__main__':
     parser.add_argument('--batch-size', type=int, default=16, help='total batch size for all GPUs')
     parser.add_argument('--img-size', nargs='+', type=int, default=[640, 640], help='[train, test] image sizes')
     parser.add_argument('--rect', action='store_true', help='rectangular training')
+    parser.add_argument('--rect-buckets', type=int, default=0, help='rectangular training with shuffled batches from '
+                        'this many aspect ratio buckets (disables mosaic)')
     parser.add_argument('--resume', nargs='?', const=True, default=False, help='resume most recent training')
     parser.add_argument('--nosave', action='store_true', help='only save final checkpoint')
     parser.add_argument('--notest', action='store_true', help='only test final epoch')
     parser.add_argument('--noautoanchor', action='store_true', help='disable autoanchor check')
     parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
     parser.add_argument('--bucket', type=str, default='', help='gsutil bucket')
-    parser.add_argument('--cache-images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--cache-images', nargs='?', const='ram', default=False,
+                        help='cache images for faster training in "ram" (default), "shm" (shared by all ranks/workers) '
+                             'or "disk" (sharded files next to the images)')
+    parser.add_argument('--cache-codec', default='none', choices=['none', 'zlib', 'lz4'], help='--cache-images disk codec')
+    parser.add_argument('--cache-images-gb', type=float, default=0.0, help='LRU image cache budget (GB) if not --cache-images')
+    parser.add_argument('--decode', default='cv2', choices=['cv2', 'reduced'], help='image decode backend, '
+                        '"reduced" lets libjpeg downscale JPEGs by 2, 4 or 8 while still covering --img-size')
+    parser.add_argument('--instance-bank', action='store_true', help='extract paste_in instance crops once at startup')
+    parser.add_argument('--mmap-instances', action='store_true', help='--instance-bank saved to disk and mmapped')
+    parser.add_argument('--batch-augment', action='store_true', help='apply mosaic/perspective/hsv/flip per batch in collate')
     parser.add_argument('--image-weights', action='store_true', help='use weighted image selection for training')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--multi-scale', action='store_true', help='vary img-size +/- 50%%')
@@ -546,6 +570,8 @@ if __name__ == '__main__':
     parser.add_argument('--sync-bn', action='store_true', help='use SyncBatchNorm, only available in DDP mode')
     parser.add_argument('--local_rank', type=int, default=-1, help='DDP parameter, do not modify')
     parser.add_argument('--workers', type=int, default=8, help='maximum number of dataloader workers')
+    parser.add_argument('--cache-workers', type=int, default=8, help='processes used to scan labels into the cache')
+    parser.add_argument('--mmap-labels', action='store_true', help='memory-map labels from a columnar .npy cache')
     parser.add_argument('--project', default='runs/train', help='save to project/name')
     parser.add_argument('--entity', default=None, help='W&B entity')
     parser.add_argument('--name', default='exp', help='save to project/name')
@@ -1,16 +1,23 @@
 # Dataset utils and dataloaders
 
+import atexit
 import glob
+import hashlib
 import logging
 import math
 import os
 import random
 import shutil
+import tempfile
 import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from itertools import repeat
-from multiprocessing.pool import ThreadPool
+from multiprocessing.pool import ThreadPool, Pool
 from pathlib import Path
-from threading import Thread
+from queue import Queue
+from threading import Condition, Thread
 
 import cv2
 import numpy as np
@@ -63,7 +70,9 @@ def exif_size(img):
 
 
 def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=False, cache=False, pad=0.0, rect=False,
-                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix=''):
+                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix='', cache_workers=8,
+                      mmap_labels=False, cache_codec='none', cache_gb=0.0, decode='cv2', batch_augment=False,
+                      instance_bank=False, mmap_instances=False, rect_buckets=0):
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache
     with torch_distributed_zero_first(rank):
         dataset = LoadImagesAndLabels(path, imgsz, batch_size,
@@ -75,19 +84,39 @@ def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=Fa
                                       stride=int(stride),
                                       pad=pad,
                                       image_weights=image_weights,
-                                      prefix=prefix)
+                                      prefix=prefix,
+                                      cache_workers=cache_workers,
+                                      mmap_labels=mmap_labels,
+                                      cache_codec=cache_codec,
+                                      cache_gb=cache_gb,
+                                      decode=decode,
+                                      batch_augment=batch_augment,
+                                      instance_bank=instance_bank,
+                                      mmap_instances=mmap_instances,
+                                      rect_buckets=rect_buckets)
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
+    if dataset.img_lru:
+        dataset.img_lru.split(nw)  # each worker process holds its own LRU cache
     sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
     loader = torch.utils.data.DataLoader if image_weights else InfiniteDataLoader
+    if dataset.batch_augment:  # augment whole collated batches in the workers
+        collate_fn = BatchAugment(hyp, imgsz, mosaic=dataset.mosaic)
+    else:
+        collate_fn = LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn
+    if rect_buckets:  # shuffled batches of similar aspect ratio, letterboxed to a shape chosen per batch
+        sampler = AspectRatioBatchSampler(sampler or torch.utils.data.RandomSampler(dataset), dataset, batch_size,
+                                          buckets=rect_buckets, pad=pad)
+        batching = dict(batch_sampler=sampler)
+    else:
+        batching = dict(batch_size=batch_size, sampler=sampler)
     # Use torch.utils.data.DataLoader() if dataset.properties will update during training else InfiniteDataLoader()
     dataloader = loader(dataset,
-                        batch_size=batch_size,
                         num_workers=nw,
-                        sampler=sampler,
                         pin_memory=True,
-                        collate_fn=LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn)
+                        collate_fn=collate_fn,
+                        **batching)
     return dataloader, dataset
 
 
@@ -125,8 +154,59 @@ class _RepeatSampler(object):
             yield from iter(self.sampler)
 
 
+class AspectRatioBatchSampler(torch.utils.data.Sampler):
+    """ Batch sampler for rectangular training with shuffled batches
+
+    Images are split into aspect ratio buckets of equal size. Every epoch the indices of the wrapped sampler (e.g.
+    RandomSampler or DistributedSampler) are grouped by bucket, keeping their random order within each bucket, cut
+    into batches and the batches shuffled. Each batch yields (index, shape) pairs so LoadImagesAndLabels letterboxes
+    it to the smallest stride-multiple shape that fits all of its images, as --rect does for its fixed batches.
+    """
+
+    def __init__(self, sampler, dataset, batch_size, buckets=8, pad=0.0):
+        self.sampler = sampler
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.pad = pad
+        s = dataset.shapes  # wh
+        self.ar = s[:, 1] / s[:, 0]  # aspect ratio
+        edges = np.quantile(self.ar, np.linspace(0, 1, buckets + 1)[1:-1])  # equal-count bucket edges
+        self.bucket = np.searchsorted(edges, self.ar, side='right')
+        self.epoch = 0
+
+    def __iter__(self):
+        if hasattr(self.sampler, 'set_epoch'):  # DistributedSampler, advanced here since the loader repeats forever
+            self.sampler.set_epoch(self.epoch)
+        self.epoch += 1
+        i = np.array(list(self.sampler), dtype=int)
+        images = np.asarray(self.dataset.indices)[i]  # dataset indices may be image-weighted
+        i = i[np.argsort(self.bucket[images], kind='stable')]  # group by bucket, random order within buckets
+        batches = [i[j:j + self.batch_size] for j in range(0, len(i), self.batch_size)]
+        for b in torch.randperm(len(batches)).tolist():
+            yield list(zip(batches[b].tolist(), repeat(self.batch_shape(batches[b]))))
+
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def batch_shape(self, batch):
+        # Letterbox (h, w) of a batch, as the --rect batch_shapes of LoadImagesAndLabels
+        ar = self.ar[np.asarray(self.dataset.indices)[batch]]
+        mini, maxi = ar.min(), ar.max()
+        shape = [maxi, 1] if maxi < 1 else [1, 1 / mini] if mini > 1 else [1, 1]
+        d = self.dataset
+        return tuple((np.ceil(np.array(shape) * d.img_size / d.stride + self.pad).astype(int) * d.stride).tolist())
+
+
 class LoadImages:  # for inference
-    def __init__(self, path, img_size=640, stride=32):
+    """ Images and videos of a file, folder or glob, letterboxed for inference
+
+    With prefetch > 0 up to prefetch images are read and letterboxed ahead by a thread pool (cv2 releases the GIL) and
+    video frames by a decoder thread per video, returned in order through the same (path, img, im0s, vid_cap) interface.
+    With raw=True img is None and letterboxing is left to the caller, e.g. InputBuffer. The video progress of the last
+    frame is kept in self.progress, and printed by __next__ unless verbose is False.
+    """
+
+    def __init__(self, path, img_size=640, stride=32, prefetch=0, raw=False):
         p = str(Path(path).absolute())  # os-agnostic absolute path
         if '*' in p:
             files = sorted(glob.glob(p, recursive=True))  # glob
@@ -145,8 +225,14 @@ class LoadImages:  # for inference
         self.stride = stride
         self.files = images + videos
         self.nf = ni + nv  # number of files
+        self.ni = ni  # number of images, listed before the videos
         self.video_flag = [False] * ni + [True] * nv
         self.mode = 'image'
+        self.prefetch = prefetch  # frames read ahead in background threads, 0 to read on the calling thread
+        self.raw = raw  # return original images only
+        self.verbose = True  # print video progress in __next__
+        self.progress = ''  # video progress of the last frame
+        self.pool = ThreadPool(prefetch) if prefetch and ni else None
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
@@ -156,6 +242,7 @@ class LoadImages:  # for inference
 
     def __iter__(self):
         self.count = 0
+        self.pending = deque()  # async results of the images read ahead
         return self
 
     def __next__(self):
@@ -166,7 +253,7 @@ class LoadImages:  # for inference
         if self.video_flag[self.count]:
             # Read video
             self.mode = 'video'
-            ret_val, img0 = self.cap.read()
+            ret_val, img, img0 = self.read_frame()
             if not ret_val:
                 self.count += 1
                 self.cap.release()
@@ -175,31 +262,68 @@ class LoadImages:  # for inference
                 else:
                     path = self.files[self.count]
                     self.new_video(path)
-                    ret_val, img0 = self.cap.read()
+                    ret_val, img, img0 = self.read_frame()
 
             self.frame += 1
-            print(f'video {self.count + 1}/{self.nf} ({self.frame}/{self.nframes}) {path}: ', end='')
+            self.progress = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.nframes}) {path}: '
+            if self.verbose:
+                print(self.progress, end='')
 
         else:
             # Read image
+            if self.pool:
+                while len(self.pending) < self.prefetch and self.count + len(self.pending) < self.ni:  # top up
+                    f = self.files[self.count + len(self.pending)]
+                    self.pending.append(self.pool.apply_async(self.read_image, (f,)))
+                img, img0 = self.pending.popleft().get()
+            else:
+                img, img0 = self.read_image(path)
             self.count += 1
-            img0 = cv2.imread(path)  # BGR
-            assert img0 is not None, 'Image Not Found ' + path
+            self.progress = ''
             #print(f'image {self.count}/{self.nf} {path}: ', end='')
 
+        return path, img, img0, self.cap
+
+    def read_image(self, path):
+        img0 = cv2.imread(path)  # BGR
+        assert img0 is not None, 'Image Not Found ' + path
+        return self.transform(img0), img0
+
+    def read_frame(self):
+        # Next (ret_val, img, img0) of the current video, from the decoder thread if prefetching
+        if self.prefetch:
+            x = self.frames.get()
+            return (True, *x) if x is not None else (False, None, None)
+        ret_val, img0 = self.cap.read()
+        return ret_val, self.transform(img0) if ret_val else None, img0
+
+    def decode(self, cap, frames):
+        # Read and letterbox all frames of a video in a daemon thread, None marks the end
+        while True:
+            ret_val, img0 = cap.read()
+            if not ret_val:
+                break
+            frames.put((self.transform(img0), img0))
+        frames.put(None)
+
+    def transform(self, img0):
+        if self.raw:
+            return None
+
         # Padded resize
         img = letterbox(img0, self.img_size, stride=self.stride)[0]
 
         # Convert
         img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
-        img = np.ascontiguousarray(img)
-
-        return path, img, img0, self.cap
+        return np.ascontiguousarray(img)
 
     def new_video(self, path):
         self.frame = 0
         self.cap = cv2.VideoCapture(path)
         self.nframes = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if self.prefetch:
+            self.frames = Queue(maxsize=self.prefetch)  # decoded, letterboxed frames
+            Thread(target=self.decode, args=(self.cap, self.frames), daemon=True).start()
 
     def __len__(self):
         return self.nf  # number of files
@@ -264,10 +388,22 @@ class LoadWebcam:  # for inference
 
 
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=640, stride=32):
+    """ Frames of one or more streams, read in a daemon thread per stream and returned as one batch per __next__
+
+    policy selects the frames returned: 'latest' the newest frame of each stream, 'all' every frame through a bounded
+    queue of queue_size frames that drops the oldest when full, 'stride' every frame_stride-th frame. Each returned
+    frame's sequence number and read time are set in self.seqs and self.timestamps. Sequence numbers count the frames
+    kept by the policy, so their gaps are frames overwritten before being returned, not frames skipped by 'stride'.
+    """
+
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, policy='latest', queue_size=8, frame_stride=4):
+        assert policy in ('latest', 'all', 'stride'), f'unknown stream policy {policy}'
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
+        self.poll_keys = True  # 'q' in a cv2 window quits, False when another thread owns HighGUI
+        self.policy = policy
+        self.frame_stride = frame_stride
 
         if os.path.isfile(sources):
             with open(sources, 'r') as f:
@@ -276,7 +412,11 @@ class LoadStreams:  # multiple IP or RTSP cameras
             sources = [sources]
 
         n = len(sources)
-        self.imgs = [None] * n
+        self.imgs = [None] * n  # last returned frames
+        self.frames = [deque(maxlen=queue_size if policy == 'all' else 1) for _ in range(n)]  # (seq, time, img)
+        self.seqs, self.timestamps = [0] * n, [0.0] * n
+        self.ready = Condition()  # notified when a frame is added
+        self.threads = [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
         for i, s in enumerate(sources):
             # Start the thread to read frames from the video stream
@@ -293,9 +433,10 @@ class LoadStreams:  # multiple IP or RTSP cameras
             self.fps = cap.get(cv2.CAP_PROP_FPS) % 100
 
             _, self.imgs[i] = cap.read()  # guarantee first frame
-            thread = Thread(target=self.update, args=([i, cap]), daemon=True)
+            self.frames[i].append((1, time.time(), self.imgs[i]))
+            self.threads[i] = Thread(target=self.update, args=([i, cap, self.fps or 30]), daemon=True)
             print(f' success ({w}x{h} at {self.fps:.2f} FPS).')
-            thread.start()
+            self.threads[i].start()
         print('')  # newline
 
         # check for common shapes
@@ -304,18 +445,25 @@ class LoadStreams:  # multiple IP or RTSP cameras
         if not self.rect:
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
 
-    def update(self, index, cap):
-        # Read next stream frame in a daemon thread
-        n = 0
+    def update(self, index, cap, fps):
+        # Read stream frames in a daemon thread, keeping those selected by the policy
+        n, k, im = 1, 1, self.imgs[index]  # frames read, frames kept
         while cap.isOpened():
             n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n == 4:  # read every 4th frame
-                success, im = cap.retrieve()
-                self.imgs[index] = im if success else self.imgs[index] * 0
-                n = 0
-            time.sleep(1 / self.fps)  # wait time
+            if self.policy == 'stride' and n % self.frame_stride:
+                cap.grab()  # skipped frame, not decoded
+                continue
+            k += 1
+            success, x = cap.read()
+            t = time.time()
+            if success:
+                im = x
+            else:  # stream ended or failed, keep producing black frames at the stream rate
+                im = im * 0
+                time.sleep(1 / fps)
+            with self.ready:
+                self.frames[index].append((k, t, im))  # a full deque drops its oldest frame
+                self.ready.notify_all()
 
     def __iter__(self):
         self.count = -1
@@ -323,11 +471,18 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        img0 = self.imgs.copy()
-        if cv2.waitKey(1) == ord('q'):  # q to quit
+        if self.poll_keys and cv2.waitKey(1) == ord('q'):  # q to quit
             cv2.destroyAllWindows()
             raise StopIteration
 
+        # Wait for a new frame of every stream still running, stopped streams repeat their last frame
+        with self.ready:
+            self.ready.wait_for(lambda: all(f or not t.is_alive() for f, t in zip(self.frames, self.threads)))
+            for i, f in enumerate(self.frames):
+                if f:
+                    self.seqs[i], self.timestamps[i], self.imgs[i] = f.popleft()
+        img0 = self.imgs.copy()
+
         # Letterbox
         img = [letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0] for x in img0]
 
@@ -344,21 +499,560 @@ class LoadStreams:  # multiple IP or RTSP cameras
         return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
 
+class StreamIngest:  # many IP or RTSP cameras
+    """ Scalable multi-stream ingest with the LoadStreams iterator interface
+
+    Each stream has a worker thread that connects (and reconnects with backoff when reads fail), decodes, letterboxes
+    to a shape shared by all streams and converts to RGB CHW, keeping up to queue_size frames (oldest dropped when
+    full). __next__ returns a micro-batch of up to batch_size streams with a ready frame, picked round-robin, as soon
+    as all streams are ready or max_wait seconds after the first one was, so a slow camera never stalls the others.
+    The returned sources, self.indices (positions in the sources list), self.seqs and self.timestamps are those of the
+    streams in the batch; info() reports per-stream FPS, decode time, queue depth, dropped frames and reconnects.
+    """
+
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, batch_size=0, max_wait=0.01, queue_size=1,
+                 connect_timeout=10.0):
+        self.mode = 'stream'
+        self.img_size = img_size
+        self.stride = stride
+        self.poll_keys = True  # 'q' in a cv2 window quits, False when another thread owns HighGUI
+        self.max_wait = max_wait
+
+        if os.path.isfile(sources):
+            with open(sources, 'r') as f:
+                sources = [x.strip() for x in f.read().strip().splitlines() if len(x.strip())]
+        else:
+            sources = [sources]
+
+        n = len(sources)
+        self.batch_size = min(batch_size or n, n)
+        self.sources = [clean_str(x) for x in sources]  # clean source names for later
+        self.frames = [deque(maxlen=queue_size) for _ in range(n)]  # (seq, time, img, im0)
+        self.stats = np.zeros((n, 5))  # frames, decode seconds, frame interval EMA, dropped, reconnects
+        self.wh = [None] * n  # stream frame sizes, set on first connect
+        self.ready = Condition()  # notified when a frame is added or a stream connects
+        self.shape = None  # letterbox shape of all streams, set once every stream connected or timed out
+        self.next = 0  # first stream of the next round-robin batch
+        self.indices, self.seqs, self.timestamps = [], [], []
+        self.running = True
+        for i, s in enumerate(sources):
+            url = eval(s) if s.isnumeric() else s
+            if 'youtube.com/' in str(url) or 'youtu.be/' in str(url):  # if source is YouTube video
+                check_requirements(('pafy', 'youtube_dl'))
+                import pafy
+                url = pafy.new(url).getbest(preftype="mp4").url
+            Thread(target=self.update, args=([i, url]), daemon=True).start()
+
+        # Letterbox shape covering every stream's aspect ratio, as rect batch shapes
+        with self.ready:
+            self.ready.wait_for(lambda: all(self.wh), timeout=connect_timeout)
+            wh = np.array([x for x in self.wh if x] or [(img_size, img_size)], dtype=np.float64)
+            ar = wh[:, 1] / wh[:, 0]  # aspect ratio
+            mini, maxi = ar.min(), ar.max()
+            shape = [maxi, 1] if maxi < 1 else [1, 1 / mini] if mini > 1 else [1, 1]
+            self.shape = tuple((np.ceil(np.array(shape) * img_size / stride).astype(int) * stride).tolist())
+            self.ready.notify_all()
+        print(f'{n} streams, {sum(map(bool, self.wh))} connected, letterboxed to {self.shape[1]}x{self.shape[0]}')
+
+    def update(self, index, url):
+        # Connect, read, letterbox and convert frames of one stream in a daemon thread, reconnecting on failure
+        seq, delay, t_last = 0, 1.0, None
+        while self.running:
+            cap = cv2.VideoCapture(url)
+            if cap.isOpened():
+                delay = 1.0
+                with self.ready:
+                    self.wh[index] = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                    self.ready.notify_all()
+                    self.ready.wait_for(lambda: self.shape is not None)
+                while self.running:
+                    t = time.time()
+                    success, im0 = cap.read()
+                    if not success:
+                        break
+                    img = letterbox(im0, self.shape, auto=False, stride=self.stride)[0]
+                    img = np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1))  # BGR to RGB, to 3x416x416
+                    seq += 1
+                    x = self.stats[index]
+                    x[0] += 1
+                    x[1] += time.time() - t
+                    if t_last:
+                        x[2] = 0.9 * x[2] + 0.1 * (t - t_last) if x[2] else t - t_last
+                    t_last = t
+                    with self.ready:
+                        f = self.frames[index]
+                        x[3] += len(f) == f.maxlen  # oldest frame dropped
+                        f.append((seq, t, img, im0))
+                        self.ready.notify_all()
+            cap.release()
+            self.stats[index, 4] += 1
+            t_last = None
+            print(f'WARNING: stream {self.sources[index]} unavailable, reconnecting in {delay:.0f}s')
+            time.sleep(delay)
+            delay = min(delay * 2, 30.0)  # exponential backoff
+
+    def __iter__(self):
+        self.count = -1
+        return self
+
+    def __next__(self):
+        self.count += 1
+        if self.poll_keys and cv2.waitKey(1) == ord('q'):  # q to quit
+            self.running = False
+            cv2.destroyAllWindows()
+            raise StopIteration
+
+        # Wait until every stream is ready, or max_wait after the first one was
+        n, deadline = len(self.frames), None
+        with self.ready:
+            while True:
+                ready = [i % n for i in range(self.next, self.next + n) if self.frames[i % n]]  # round-robin order
+                if len(ready) >= self.batch_size or (deadline and time.time() >= deadline):
+                    break
+                if ready and deadline is None:
+                    deadline = time.time() + self.max_wait
+                self.ready.wait(deadline - time.time() if deadline else 1.0)
+            ready = ready[:self.batch_size]
+            self.next = (ready[-1] + 1) % n
+            self.indices = ready
+            self.seqs, self.timestamps, img, img0 = zip(*(self.frames[i].popleft() for i in ready))
+        return [self.sources[i] for i in ready], np.stack(img, 0), list(img0), None
+
+    def info(self):
+        # Per-stream fps, mean decode + letterbox ms, queued frames, dropped frames and reconnects
+        stats = self.stats.tolist()
+        return [{'source': s, 'fps': 1 / x[2] if x[2] else 0.0, 'decode_ms': 1E3 * x[1] / max(x[0], 1), 'queue': len(f),
+                 'dropped': int(x[3]), 'reconnects': int(x[4])} for s, x, f in zip(self.sources, stats, self.frames)]
+
+    def __len__(self):
+        return 0  # endless
+
+
 def img2label_paths(img_paths):
     # Define label paths as a function of image paths
     sa, sb = os.sep + 'images' + os.sep, os.sep + 'labels' + os.sep  # /images/, /labels/ substrings
     return ['txt'.join(x.replace(sa, sb, 1).rsplit(x.split('.')[-1], 1)) for x in img_paths]
 
 
+def file_fingerprint(files):
+    # Returns a (size, mtime) fingerprint per file in files, None for missing files
+    fp = []
+    for f in files:
+        try:
+            st = os.stat(f)
+            fp.append((st.st_size, st.st_mtime_ns))
+        except OSError:
+            fp.append(None)
+    return tuple(fp)
+
+
+def verify_image_label(args):
+    # Verify one image-label pair, returns im_file, labels, shape, segments, counts (missing, found, empty, corrupt), msg
+    im_file, lb_file, prefix = args
+    nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, corrupt
+    try:
+        # verify images
+        im = Image.open(im_file)
+        im.verify()  # PIL verify
+        shape = exif_size(im)  # image size
+        segments = []  # instance segments
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        assert im.format.lower() in img_formats, f'invalid image format {im.format}'
+
+        # verify labels
+        if os.path.isfile(lb_file):
+            nf = 1  # label found
+            with open(lb_file, 'r') as f:
+                l = [x.split() for x in f.read().strip().splitlines()]
+                if any([len(x) > 8 for x in l]):  # is segment
+                    classes = np.array([x[0] for x in l], dtype=np.float32)
+                    segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
+                    l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
+                l = np.array(l, dtype=np.float32)
+            if len(l):
+                assert l.shape[1] == 5, 'labels require 5 columns each'
+                assert (l >= 0).all(), 'negative labels'
+                assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
+                assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+            else:
+                ne = 1  # label empty
+                l = np.zeros((0, 5), dtype=np.float32)
+        else:
+            nm = 1  # label missing
+            l = np.zeros((0, 5), dtype=np.float32)
+        return im_file, l, shape, segments, nm, nf, ne, nc, ''
+    except Exception as e:
+        nc = 1
+        return im_file, None, None, None, nm, nf, ne, nc, f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}'
+
+
+class RaggedArray:
+    """ Read-only sequence of variable-length arrays stored as one flat array plus start/end offsets
+
+    Indexing with an int returns the zero-copy view data[starts[i]:ends[i]], with a slice a list of views, and with
+    an index array a reordered RaggedArray over the same data. data may itself be a RaggedArray (nested sequences).
+    """
+
+    def __init__(self, data, starts, ends):
+        self.data = data
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            return self.data[self.starts[i]:self.ends[i]]
+        elif isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return RaggedArray(self.data, self.starts[i], self.ends[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def save_label_arrays(path, labels, shapes, segments):
+    # Save per-image labels, shapes and segments as flat columnar .npy arrays with offset indices
+    def offsets(x):
+        return np.concatenate(([0], np.cumsum([len(v) for v in x]))).astype(np.int64)
+
+    path.mkdir(parents=True, exist_ok=True)
+    points = [x for s in segments for x in s]  # all segments of all images
+    np.save(path / 'shapes.npy', np.array(shapes, dtype=np.float64))
+    np.save(path / 'label_offsets.npy', offsets(labels))
+    np.save(path / 'segment_offsets.npy', offsets(segments))
+    np.save(path / 'point_offsets.npy', offsets(points))
+    np.save(path / 'points.npy', np.concatenate(points, 0).astype(np.float32) if points else np.zeros((0, 2), np.float32))
+    np.save(path / 'labels.npy', np.concatenate(labels, 0).astype(np.float32))  # written last, marks a complete cache
+
+
+def load_label_arrays(path, mmap_mode='r'):
+    # Memory-map columnar label arrays written by save_label_arrays(), returns labels, shapes, segments
+    f = lambda x: np.load(path / f'{x}.npy', mmap_mode=mmap_mode)
+    lo, so, po = f('label_offsets'), f('segment_offsets'), f('point_offsets')
+    labels = RaggedArray(f('labels'), lo[:-1], lo[1:])
+    segments = RaggedArray(RaggedArray(f('points'), po[:-1], po[1:]), so[:-1], so[1:])
+    return labels, f('shapes'), segments
+
+
+@contextmanager
+def file_lock(path):
+    # Hold an exclusive lock on path across processes (no-op where fcntl is unavailable, i.e. Windows)
+    with open(path, 'w') as f:
+        try:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)  # released when f is closed
+        except ImportError:
+            pass
+        yield
+
+
+class SharedImageCache:
+    """ Resized images packed back to back in one memory-mapped file in /dev/shm (or the temp dir if there is none)
+
+    The first process to open the cache fills it, every other DDP rank and DataLoader worker maps the same pages
+    read-only. Indexing returns a zero-copy (h, w, 3) uint8 view. The file is removed when the filling process exits.
+    """
+
+    def __init__(self, name, hw):
+        self.hw = np.asarray(hw, dtype=np.int64)  # (n, 2) resized image shapes
+        self.offsets = np.concatenate(([0], np.cumsum(self.hw.prod(1) * 3)))  # byte offset of each image
+        root = Path('/dev/shm') if os.path.isdir('/dev/shm') else Path(tempfile.gettempdir())
+        self.path = root / f'{name}.bin'
+        self.buf = None
+
+    def open(self, load_fn, prefix=''):
+        # Map the cache, filling it first with load_fn(index) -> load_image() output if no other process has done so
+        with file_lock(self.path.with_suffix('.lock')):
+            if not self.path.exists():
+                self.fill(load_fn, prefix)
+        self.buf = np.memmap(self.path, dtype=np.uint8, mode='r', shape=(int(self.offsets[-1]),))
+
+    def fill(self, load_fn, prefix=''):
+        n, gb = len(self.hw), 0
+        f = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        buf = np.memmap(f, dtype=np.uint8, mode='w+', shape=(int(self.offsets[-1]),))
+        pbar = tqdm(enumerate(ThreadPool(8).imap(load_fn, range(n))), total=n)
+        for i, (im, _, _) in pbar:
+            h, w = self.hw[i]
+            if im.shape[:2] != (h, w):  # i.e. EXIF orientation not reflected in the label cache shapes
+                im = cv2.resize(im, (int(w), int(h)), interpolation=cv2.INTER_AREA)
+            buf[self.offsets[i]:self.offsets[i + 1]] = im.reshape(-1)
+            gb += im.nbytes
+            pbar.desc = f'{prefix}Caching images in {self.path.parent} ({gb / 1E9:.1f}GB)'
+        pbar.close()
+        buf.flush()
+        del buf
+        os.replace(f, self.path)  # atomic, other processes only ever see a complete cache
+        atexit.register(self.remove, os.getpid())
+
+    def remove(self, pid):
+        if os.getpid() == pid:  # filling process only, not forked DataLoader workers
+            for f in self.path, self.path.with_suffix('.lock'):
+                if f.exists():
+                    f.unlink()
+
+    def __len__(self):
+        return len(self.hw)
+
+    def __getitem__(self, i):
+        h, w = self.hw[i]
+        return self.buf[self.offsets[i]:self.offsets[i + 1]].reshape(h, w, 3)
+
+    def __getstate__(self):
+        return {**self.__dict__, 'buf': None}  # pickled into spawned workers by path, not by content
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buf = np.memmap(self.path, dtype=np.uint8, mode='r', shape=(int(self.offsets[-1]),))
+
+
+class DiskImageCache:
+    """ Resized images packed into large shard files with an offset index, optionally compressed with zlib or lz4
+
+    Shards are written once, sequentially, and memory-mapped for reading, so cold epochs are bounded by disk
+    bandwidth instead of JPEG decode. The index (shard, offset, nbytes, h, w, h0, w0) is written last and marks a
+    complete cache; an existing complete cache is reused as-is.
+    """
+
+    def __init__(self, path, n, codec='none', shard_size=1 << 30):
+        assert codec in ('none', 'zlib', 'lz4'), f'unknown cache codec {codec}'
+        if codec == 'lz4':
+            check_requirements(('lz4',))
+        self.path = Path(path)  # shards are path_000.bin, path_001.bin, ..., index is path.npy
+        self.n = n
+        self.codec = codec
+        self.shard_size = shard_size
+        self.index = None
+        self.shards = None  # mapped lazily in each process
+
+    def open(self, load_fn, prefix=''):
+        # Load the index, filling the cache first with load_fn(index) -> load_image() output if it is incomplete
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.path.with_suffix('.lock')):
+            if not self.path.with_suffix('.npy').exists():
+                self.fill(load_fn, prefix)
+        self.index = np.load(self.path.with_suffix('.npy'))
+
+    def fill(self, load_fn, prefix=''):
+        index = np.zeros((self.n, 7), dtype=np.int64)  # shard, offset, nbytes, h, w, h0, w0
+        shard, offset, gb, f = -1, 0, 0, None
+        encode = lambda x: (self.compress(x[0]), x[1], x[2])  # compress in the pool, codecs release the GIL
+        pbar = tqdm(enumerate(ThreadPool(8).imap(lambda i: encode(load_fn(i)), range(self.n))), total=self.n)
+        for i, (b, (h0, w0), (h, w)) in pbar:
+            if f is None or (offset and offset + len(b) > self.shard_size):  # start a new shard
+                if f:
+                    f.close()
+                shard, offset = shard + 1, 0
+                f = open(self.shard_file(shard), 'wb')
+            f.write(b)
+            index[i] = shard, offset, len(b), h, w, h0, w0
+            offset += len(b)
+            gb += len(b)
+            pbar.desc = f'{prefix}Caching images to {self.path.parent} ({gb / 1E9:.1f}GB {self.codec})'
+        pbar.close()
+        f.close()
+        np.save(self.path.with_suffix('.npy'), index)  # written last, marks a complete cache
+
+    def shard_file(self, i):
+        return self.path.parent / f'{self.path.name}_{i:03d}.bin'
+
+    def compress(self, im):
+        im = np.ascontiguousarray(im)
+        if self.codec == 'zlib':
+            return zlib.compress(im, 1)
+        elif self.codec == 'lz4':
+            import lz4.frame
+            return lz4.frame.compress(im)
+        return im.data.cast('B')
+
+    def decompress(self, b):
+        if self.codec == 'zlib':
+            return zlib.decompress(b)
+        elif self.codec == 'lz4':
+            import lz4.frame
+            return lz4.frame.decompress(b)
+        return b
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if self.shards is None:
+            self.shards = [np.memmap(self.shard_file(j), dtype=np.uint8, mode='r')
+                           for j in range(self.index[:, 0].max() + 1)]
+        shard, offset, nb, h, w = self.index[i, :5]
+        b = self.decompress(self.shards[shard][offset:offset + nb])
+        return np.frombuffer(b, dtype=np.uint8).reshape(h, w, 3)
+
+    def __getstate__(self):
+        return {**self.__dict__, 'shards': None}  # re-mapped in spawned workers
+
+
+class LRUImageCache:
+    """ Least-recently-used cache of load_image() results bounded by a byte budget
+
+    Every DataLoader worker fills its own cache (create_dataloader() splits the budget between workers), while the
+    hits, misses, evictions and cached bytes counters live in shared memory so the training process can log them. Each
+    worker only writes its own row of counters, info() sums the rows.
+    """
+
+    def __init__(self, max_bytes, workers=1):
+        self.max_bytes = max_bytes
+        self.nbytes = 0  # this process
+        self.cache = OrderedDict()  # index: (img, hw_original, hw_resized)
+        self.stats = torch.zeros(workers, 4, dtype=torch.int64).share_memory_()  # hits, misses, evictions, bytes
+
+    def split(self, workers):
+        # Share the budget between DataLoader worker processes, each with its own row of counters
+        workers = max(workers, 1)
+        self.max_bytes //= workers
+        self.stats = torch.zeros(workers, 4, dtype=torch.int64).share_memory_()
+
+    def counters(self):
+        # Counters of this process, row 0 when loading in the main process
+        w = torch.utils.data.get_worker_info()
+        return self.stats[w.id if w else 0]
+
+    def get(self, index):
+        x = self.cache.get(index)
+        if x is None:
+            self.counters()[1] += 1
+        else:
+            self.cache.move_to_end(index)
+            self.counters()[0] += 1
+        return x
+
+    def put(self, index, x):
+        nb = x[0].nbytes
+        if nb > self.max_bytes:
+            return
+        stats = self.counters()
+        self.cache[index] = x
+        self.nbytes += nb
+        stats[3] += nb
+        while self.nbytes > self.max_bytes:  # evict least recently used
+            im = self.cache.popitem(last=False)[1][0]
+            self.nbytes -= im.nbytes
+            stats[2] += 1
+            stats[3] -= im.nbytes
+
+    def info(self):
+        hits, misses, evictions, nb = self.stats.sum(0).tolist()
+        return {'hits': hits, 'misses': misses, 'evictions': evictions, 'hit_rate': hits / max(hits + misses, 1),
+                'gb': nb / 1E9}
+
+
+class InstanceBank:
+    """ Segment crops and masks of every labelled instance, extracted once at load_image() resolution for pastein()
+
+    Crops are packed into one flat BGR pixel array and one mask array with an (offset, h, w, image, label) index. If a
+    path is given the arrays are saved as .npy files (index last, marks a complete bank) and memory-mapped, so later
+    runs, DDP ranks and DataLoader workers share one copy through the page cache.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.pixels, self.masks, self.index = None, None, None
+        self.cls = None  # class of each instance, read from the current (possibly single_cls) labels
+
+    def open(self, dataset, prefix=''):
+        # Build the bank from dataset images and segments, or load it if a complete bank exists at self.path
+        if self.path is None:
+            self.pixels, self.masks, self.index = self.fill(dataset, prefix)
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with file_lock(self.path / 'bank.lock'):
+                if not (self.path / 'index.npy').exists():
+                    pixels, masks, index = self.fill(dataset, prefix)
+                    np.save(self.path / 'pixels.npy', pixels)
+                    np.save(self.path / 'masks.npy', masks)
+                    np.save(self.path / 'index.npy', index)  # written last, marks a complete bank
+            self.load()
+        self.cls = np.array([dataset.labels[i][j, 0] for i, j in self.index[:, 3:5]], dtype=np.float32)
+
+    def load(self):
+        self.pixels, self.masks, self.index = (np.load(self.path / f'{x}.npy', mmap_mode='r')
+                                               for x in ('pixels', 'masks', 'index'))
+
+    @staticmethod
+    def extract(dataset, i):
+        # Crops (h,w,3) and masks (h,w) of the segments of image i, cut at their label boxes as in sample_segments()
+        crops, masks, labels = [], [], []
+        segments = dataset.segments[i]
+        if not len(segments):
+            return crops, masks, labels
+        img, _, (h, w) = load_image(dataset, i)
+        boxes = xywhn2xyxy(dataset.labels[i][:, 1:], w, h).astype(int)
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w - 1)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h - 1)
+        for j, ((x1, y1, x2, y2), s) in enumerate(zip(boxes, segments)):
+            if x2 <= x1 or y2 <= y1:
+                continue
+            mask = np.zeros((y2 - y1, x2 - x1), np.uint8)
+            cv2.drawContours(mask, [(xyn2xy(s, w, h) - (x1, y1)).astype(np.int32)], -1, 255, cv2.FILLED)
+            crops.append(cv2.bitwise_and(img[y1:y2, x1:x2], img[y1:y2, x1:x2], mask=mask))
+            masks.append(mask)
+            labels.append(j)
+        return crops, masks, labels
+
+    def fill(self, dataset, prefix=''):
+        n = len(dataset.img_files)
+        pixels, masks, index, offset = [], [], [], 0
+        pbar = tqdm(enumerate(ThreadPool(8).imap(lambda i: self.extract(dataset, i), range(n))), total=n)
+        for i, (c, m, j) in pbar:
+            for crop, mask, label in zip(c, m, j):
+                h, w = mask.shape
+                pixels.append(crop.reshape(-1, 3))
+                masks.append(mask.reshape(-1))
+                index.append((offset, h, w, i, label))
+                offset += h * w
+            pbar.desc = f'{prefix}Extracting instances ({len(index)} found, {offset * 4 / 1E9:.1f}GB)'
+        pbar.close()
+        return (np.concatenate(pixels, 0) if pixels else np.zeros((0, 3), np.uint8),
+                np.concatenate(masks, 0) if masks else np.zeros(0, np.uint8),
+                np.array(index, dtype=np.int64).reshape(-1, 5))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        # Class, crop (h,w,3) and mask (h,w) views of instance i
+        if self.pixels is None:
+            self.load()
+        o, h, w = self.index[i, :3]
+        return self.cls[i], self.pixels[o:o + h * w].reshape(h, w, 3), self.masks[o:o + h * w].reshape(h, w)
+
+    def sample(self, k=30):
+        # k random instances as the (labels, images, masks) lists pastein() expects
+        x = [self[i] for i in np.random.randint(0, len(self), k)] if len(self) else []
+        return tuple(map(list, zip(*x))) if x else ([], [], [])
+
+    def __getstate__(self):
+        if self.path is None:
+            return self.__dict__
+        return {**self.__dict__, 'pixels': None, 'masks': None}  # re-mapped in spawned workers
+
+
 class LoadImagesAndLabels(Dataset):  # for training/testing
+    cache_version = 0.2  # label cache version, bump on layout changes
+
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix=''):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', cache_workers=8,
+                 mmap_labels=False, cache_codec='none', cache_gb=0.0, decode='cv2', batch_augment=False,
+                 instance_bank=False, mmap_instances=False, rect_buckets=0):
+        assert decode in ('cv2', 'reduced'), f'unknown decode backend {decode}'
         self.img_size = img_size
+        self.decode = decode  # 'reduced' decodes JPEGs at 1/2, 1/4 or 1/8 resolution when that still covers img_size
         self.augment = augment
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
-        self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
+        self.rect_buckets = rect_buckets  # letterbox shapes come from AspectRatioBatchSampler
+        self.mosaic = self.augment and not self.rect and not rect_buckets  # load 4-image mosaics (only during training)
+        self.batch_augment = batch_augment and self.mosaic  # augment in BatchAugment collate_fn
         self.mosaic_border = [-img_size // 2, -img_size // 2]
         self.stride = stride
         self.path = path        
@@ -390,10 +1084,13 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')  # cached labels
         if cache_path.is_file():
             cache, exists = torch.load(cache_path), True  # load
-            #if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-            #    cache, exists = self.cache_labels(cache_path, prefix), False  # re-cache
+            if cache.get('version') != self.cache_version:  # old cache layout
+                cache, exists = self.cache_labels(cache_path, prefix, cache_workers), False  # re-cache
+            else:  # rescan new, removed or modified files only, cache is returned as-is if nothing changed
+                x = self.cache_labels(cache_path, prefix, cache_workers, cache=cache)
+                cache, exists = x, x is cache
         else:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # cache
+            cache, exists = self.cache_labels(cache_path, prefix, cache_workers), False  # cache
 
         # Display cache
         nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
@@ -405,11 +1102,19 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Read cache
         cache.pop('hash')  # remove hash
         cache.pop('version')  # remove version
+        cache.pop('files')  # remove per-file fingerprints
         labels, shapes, self.segments = zip(*cache.values())
         self.labels = list(labels)
         self.shapes = np.array(shapes, dtype=np.float64)
         self.img_files = list(cache.keys())  # update
         self.label_files = img2label_paths(cache.keys())  # update
+        if mmap_labels:  # replace per-image arrays with zero-copy views into memory-mapped columnar arrays
+            npy_dir = Path(str(cache_path.with_suffix('')) + '_npy')
+            f = npy_dir / 'labels.npy'
+            if not exists or not f.is_file() or f.stat().st_mtime < cache_path.stat().st_mtime:  # missing or stale
+                save_label_arrays(npy_dir, self.labels, shapes, self.segments)
+            del cache, labels
+            self.labels, self.shapes, self.segments = load_label_arrays(npy_dir, mmap_mode='c' if single_cls else 'r')
         if single_cls:
             for x in self.labels:
                 x[:, 0] = 0
@@ -429,7 +1134,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             irect = ar.argsort()
             self.img_files = [self.img_files[i] for i in irect]
             self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
+            self.labels = self.labels[irect] if mmap_labels else [self.labels[i] for i in irect]
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
@@ -447,79 +1152,107 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
         self.imgs = [None] * n
-        if cache_images:
+        self.img_lru = None
+        if cache_images in ('shm', 'disk'):
+            key = str((self.img_files, self.shapes.tobytes(), img_size, augment, decode))
+            key = hashlib.md5(key.encode()).hexdigest()
+            if cache_images == 'shm':  # one shared block filled once, mapped read-only by all DDP ranks and workers
+                s = self.shapes  # wh
+                r = (img_size / s.max(1)).reshape(-1, 1)  # resize ratios, as in load_image()
+                self.img_hw0 = s[:, ::-1].astype(int)  # hw_original
+                self.img_hw = np.where(r != 1, s[:, ::-1] * r, s[:, ::-1]).astype(int)  # hw_resized
+                cache = SharedImageCache(f'yolov7_{key[:16]}', self.img_hw)
+            else:  # resized images packed into large (compressed) shards next to the images, read back through mmap
+                cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_cache')
+                cache = DiskImageCache(cache_dir / f'{key[:16]}_{cache_codec}', n, codec=cache_codec)
+            cache.open(lambda i: load_image(self, i), prefix)
             if cache_images == 'disk':
-                self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
-                self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
-                self.im_cache_dir.mkdir(parents=True, exist_ok=True)
+                self.img_hw0, self.img_hw = cache.index[:, 5:7], cache.index[:, 3:5]
+            self.imgs = cache
+        elif cache_images:
             gb = 0  # Gigabytes of cached images
             self.img_hw0, self.img_hw = [None] * n, [None] * n
             results = ThreadPool(8).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))
             pbar = tqdm(enumerate(results), total=n)
             for i, x in pbar:
-                if cache_images == 'disk':
-                    if not self.img_npy[i].exists():
-                        np.save(self.img_npy[i].as_posix(), x[0])
-                    gb += self.img_npy[i].stat().st_size
-                else:
-                    self.imgs[i], self.img_hw0[i], self.img_hw[i] = x
-                    gb += self.imgs[i].nbytes
+                self.imgs[i], self.img_hw0[i], self.img_hw[i] = x
+                gb += self.imgs[i].nbytes
                 pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
             pbar.close()
-
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
+        elif cache_gb:  # keep the most recently used images within a byte budget
+            self.img_lru = LRUImageCache(int(cache_gb * 1E9))
+
+        # Instance crops for paste_in, extracted once instead of cut from a new 4-mosaic for every augmented sample.
+        # Opt-in: the bank decodes the whole dataset up front, in RAM per process unless mmap_instances puts it on disk
+        self.instances = None
+        if (instance_bank or mmap_instances) and self.augment and not self.batch_augment and hyp and \
+                hyp.get('paste_in', 0) > 0:
+            key = hashlib.md5(str((self.img_files, img_size)).encode()).hexdigest()
+            path = Path(str(cache_path.with_suffix('')) + f'_instances/{key[:16]}') if mmap_instances else None
+            f = path / 'index.npy' if path else None
+            if f and f.is_file() and f.stat().st_mtime < cache_path.stat().st_mtime:
+                shutil.rmtree(path, ignore_errors=True)  # stale, labels changed since the bank was written
+            lru, self.img_lru = self.img_lru, None  # do not fill the LRU cache from the main process
+            self.instances = InstanceBank(path)
+            self.instances.open(self, prefix)
+            self.img_lru = lru
+
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', workers=8, cache=None):
+        # Cache dataset labels, check images and read shapes. If an existing cache is passed only the image-label pairs
+        # whose (size, mtime) fingerprint changed are verified again, and the cache is returned unchanged if none did
+        n = len(self.img_files)
+        files = cache['files'] if cache else {}  # {im_file: (fingerprint, (nm, nf, ne, nc))}
+        with ThreadPool(max(workers, 1)) as pool:
+            fingerprints = pool.map(file_fingerprint, zip(self.img_files, self.label_files), chunksize=256)
+        todo = [i for i, (f, fp) in enumerate(zip(self.img_files, fingerprints)) if f not in files or files[f][0] != fp]
+        if cache and not todo and len(files) == n:
+            return cache
+
+        # Verify new and modified files
+        new = {}  # {im_file: [labels, shape, segments] or None if corrupt}
         nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, duplicate
-        pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
-        for i, (im_file, lb_file) in enumerate(pbar):
-            try:
-                # verify images
-                im = Image.open(im_file)
-                im.verify()  # PIL verify
-                shape = exif_size(im)  # image size
-                segments = []  # instance segments
-                assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-                assert im.format.lower() in img_formats, f'invalid image format {im.format}'
-
-                # verify labels
-                if os.path.isfile(lb_file):
-                    nf += 1  # label found
-                    with open(lb_file, 'r') as f:
-                        l = [x.split() for x in f.read().strip().splitlines()]
-                        if any([len(x) > 8 for x in l]):  # is segment
-                            classes = np.array([x[0] for x in l], dtype=np.float32)
-                            segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
-                            l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                        l = np.array(l, dtype=np.float32)
-                    if len(l):
-                        assert l.shape[1] == 5, 'labels require 5 columns each'
-                        assert (l >= 0).all(), 'negative labels'
-                        assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
-                    else:
-                        ne += 1  # label empty
-                        l = np.zeros((0, 5), dtype=np.float32)
-                else:
-                    nm += 1  # label missing
-                    l = np.zeros((0, 5), dtype=np.float32)
-                x[im_file] = [l, shape, segments]
-            except Exception as e:
-                nc += 1
-                print(f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}')
-
-            pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
-                        f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
+        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+        args = zip([self.img_files[i] for i in todo], [self.label_files[i] for i in todo], repeat(prefix))
+        if workers > 1:  # verify in a process pool, chunked to cut IPC overhead
+            pool = Pool(workers)
+            results = pool.imap(verify_image_label, args, chunksize=max(1, min(len(todo) // (workers * 4), 256)))
+        else:
+            pool, results = None, map(verify_image_label, args)
+        pbar = tqdm(zip(todo, results), desc=desc, total=len(todo))
+        for i, (im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg) in pbar:
+            nm += nm_f
+            nf += nf_f
+            ne += ne_f
+            nc += nc_f
+            files[im_file] = fingerprints[i], (nm_f, nf_f, ne_f, nc_f)
+            new[im_file] = None if nc_f else [l, shape, segments]
+            if msg:
+                print(msg)
+            pbar.desc = f"{desc} {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
         pbar.close()
+        if pool:
+            pool.close()
+            pool.join()
 
+        # Merge with unchanged entries, dropping removed files
+        x = {}  # dict
+        stats = np.zeros(4, dtype=int)  # number missing, found, empty, duplicate
+        for im_file in self.img_files:
+            v = new[im_file] if im_file in new else cache.get(im_file)
+            if v is not None:
+                x[im_file] = v
+            stats += files[im_file][1]
+        nm, nf, ne, nc = stats.tolist()
         if nf == 0:
             print(f'{prefix}WARNING: No labels found in {path}. See {help_url}')
 
-        x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, i + 1
-        x['version'] = 0.1  # cache version
+        x['files'] = {f: files[f] for f in self.img_files}
+        x['hash'] = sum(s[0] for fp in x['files'].values() for s in fp[0] if s)  # total file size, as get_hash()
+        x['results'] = nf, nm, ne, nc, n
+        x['version'] = self.cache_version  # cache version
         torch.save(x, path)  # save for next time
-        logging.info(f'{prefix}New cache created: {path}')
+        logging.info(f'{prefix}New cache created: {path}' if not cache else
+                     f'{prefix}Cache updated: {path} ({len(todo)} files rescanned)')
         return x
 
     def __len__(self):
@@ -532,7 +1265,10 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
     #     return self
 
     def __getitem__(self, index):
+        index, shape = index if isinstance(index, tuple) else (index, None)  # (index, shape) from --rect-buckets
         index = self.indices[index]  # linear, shuffled, or image_weights
+        if self.batch_augment:
+            return self.load_batch_sample(index)
 
         hyp = self.hyp
         mosaic = self.mosaic and random.random() < hyp['mosaic']
@@ -559,7 +1295,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             img, (h0, w0), (h, w) = load_image(self, index)
 
             # Letterbox
-            shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
+            if shape is None:
+                shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
             img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
@@ -588,15 +1325,18 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             #     labels = cutout(img, labels)
             
             if random.random() < hyp['paste_in']:
-                sample_labels, sample_images, sample_masks = [], [], [] 
-                while len(sample_labels) < 30:
-                    sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
-                    sample_labels += sample_labels_
-                    sample_images += sample_images_
-                    sample_masks += sample_masks_
-                    #print(len(sample_labels))
-                    if len(sample_labels) == 0:
-                        break
+                if self.instances is not None:
+                    sample_labels, sample_images, sample_masks = self.instances.sample(30)
+                else:
+                    sample_labels, sample_images, sample_masks = [], [], [] 
+                    while len(sample_labels) < 30:
+                        sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
+                        sample_labels += sample_labels_
+                        sample_images += sample_images_
+                        sample_masks += sample_masks_
+                        #print(len(sample_labels))
+                        if len(sample_labels) == 0:
+                            break
                 labels = pastein(img, labels, sample_labels, sample_images, sample_masks)
 
         nL = len(labels)  # number of labels
@@ -628,6 +1368,20 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         return torch.from_numpy(img), labels_out, self.img_files[index], shapes
 
+    def load_batch_sample(self, index):
+        # Un-augmented sample for BatchAugment: resized image at the top-left of an img_size canvas, pixel xyxy labels
+        img, _, (h, w) = load_image(self, index)
+        s = self.img_size
+        canvas = np.full((s, s, 3), 114, dtype=np.uint8)
+        canvas[:h, :w] = img
+        labels = self.labels[index].copy()
+        if labels.size:
+            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h)  # normalized xywh to pixel xyxy format
+        labels_out = torch.zeros((len(labels), 6))
+        labels_out[:, 1:] = torch.from_numpy(labels)
+        img = np.ascontiguousarray(canvas[:, :, ::-1].transpose(2, 0, 1))  # BGR to RGB, to 3x416x416
+        return torch.from_numpy(img), labels_out, self.img_files[index], (h, w)
+
     @staticmethod
     def collate_fn(batch):
         img, label, path, shapes = zip(*batch)  # transposed
@@ -667,17 +1421,36 @@ def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
     img = self.imgs[index]
     if img is None:  # not cached
+        x = self.img_lru.get(index) if self.img_lru else None
+        if x is not None:
+            return x
         path = self.img_files[index]
-        img = cv2.imread(path)  # BGR
+        if self.decode == 'reduced' and path.lower().endswith(('.jpg', '.jpeg')):
+            img, f = imread_reduced(path, max(self.shapes[index]) / self.img_size)  # BGR
+        else:
+            img, f = cv2.imread(path), 1  # BGR
         assert img is not None, 'Image Not Found ' + path
-        h0, w0 = img.shape[:2]  # orig hw
+        if f > 1:  # decoded at reduced resolution
+            w0, h0 = map(int, self.shapes[index])  # orig wh from the label cache
+        else:
+            h0, w0 = img.shape[:2]  # orig hw
         r = self.img_size / max(h0, w0)  # resize image to img_size
         if r != 1:  # always resize down, only resize up if training with augmentation
             interp = cv2.INTER_AREA if r < 1 and not self.augment else cv2.INTER_LINEAR
             img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+        if self.img_lru:
+            self.img_lru.put(index, (img, (h0, w0), img.shape[:2]))
         return img, (h0, w0), img.shape[:2]  # img, hw_original, hw_resized
     else:
-        return self.imgs[index], self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
+        return img, self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
+
+
+def imread_reduced(path, scale):
+    # Read a BGR image, letting libjpeg downscale in the DCT domain by the largest factor 8, 4 or 2 not exceeding scale
+    for f, flag in (8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2):
+        if scale >= f:
+            return cv2.imread(path, flag), f
+    return cv2.imread(path), 1
 
 
 def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
@@ -897,14 +1670,20 @@ def copy_paste(img, labels, segments, probability=0.5):
     if probability and n:
         h, w, c = img.shape  # height, width, channels
         im_new = np.zeros(img.shape, np.uint8)
-        for j in random.sample(range(n), k=round(probability * n)):
-            l, s = labels[j], segments[j]
-            box = w - l[3], l[2], w - l[1], l[4]
-            ioa = bbox_ioa(box, labels[:, 1:5])  # intersection over area
-            if (ioa < 0.30).all():  # allow 30% obscuration of existing labels
-                labels = np.concatenate((labels, [[l[0], *box]]), 0)
-                segments.append(np.concatenate((w - s[:, 0:1], s[:, 1:2]), 1))
-                cv2.drawContours(im_new, [segments[j].astype(np.int32)], -1, (255, 255, 255), cv2.FILLED)
+        j = np.array(random.sample(range(n), k=round(probability * n)), dtype=int)
+        l = labels[j]
+        box = np.stack((w - l[:, 3], l[:, 2], w - l[:, 1], l[:, 4]), 1)  # flipped left-right
+        ok = (bbox_ioa(box, labels[:, 1:5]) < 0.30).all(1)  # allow 30% obscuration of existing labels
+        ioa = bbox_ioa(box, box)  # and of boxes pasted before
+        keep = []
+        for k in np.nonzero(ok)[0]:
+            if not keep or (ioa[k, keep] < 0.30).all():
+                keep.append(k)
+        if keep:
+            labels = np.concatenate((labels, np.concatenate((l[keep, :1], box[keep]), 1)), 0)
+            segments.extend(np.concatenate((w - segments[i][:, 0:1], segments[i][:, 1:2]), 1) for i in j[keep])
+            for i in j[keep]:  # one call per contour, overlapping contours drawn together would cancel out
+                cv2.drawContours(im_new, [segments[i].astype(np.int32)], -1, (255, 255, 255), cv2.FILLED)
 
         result = cv2.bitwise_and(src1=img, src2=im_new)
         result = cv2.flip(result, 1)  # augment segments (flip left-right)
@@ -1014,6 +1793,67 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     return img, ratio, (dw, dh)
 
 
+class InputBuffer:
+    """ Preallocated inference inputs: letterbox into reusable (pinned) host buffers, normalize on the device
+
+    load() letterboxes a batch of BGR images straight into one of slots host buffers of uint8 BGR HWC layout (each
+    image at the top-left of the batch shape, as detect.py pads batches). to_device() copies the slot into a device
+    buffer and converts it to normalized RGB CHW in one multiply per channel, written into a reused output tensor.
+    Buffers are allocated once per batch shape, so there are no per-frame allocations once every shape has been seen.
+    Use at least one slot more than the images that can be in flight between load() and to_device().
+    """
+
+    def __init__(self, device, half=False, img_size=640, stride=32, auto=True, slots=4):
+        self.device = device
+        self.dtype = torch.float16 if half else torch.float32
+        self.img_size = img_size
+        self.stride = stride
+        self.auto = auto
+        self.slots = slots
+        self.pin = device.type != 'cpu'  # pinned host memory for asynchronous copies
+        self.host = {}  # (b, h, w): uint8 BGR HWC host tensors, one per slot
+        self.dev = {}  # (b, h, w): uint8 BGR HWC device tensor, normalized RGB CHW output tensor
+        self.i = 0  # next slot
+
+    def load(self, imgs):
+        # Letterbox BGR images into the next host slot, returns (key, slot) for to_device() and letterboxed shapes
+        s, boxes = self.img_size, []
+        for img in imgs:
+            h0, w0 = img.shape[:2]
+            r = min(s / h0, s / w0)
+            w, h = int(round(w0 * r)), int(round(h0 * r))  # new_unpad
+            dw, dh = (int(np.mod(s - w, self.stride)), int(np.mod(s - h, self.stride))) if self.auto else (s - w, s - h)
+            top, left = int(round(dh / 2 - 0.1)), int(round(dw / 2 - 0.1))  # as letterbox()
+            boxes.append((w, h, top, left, h + dh, w + dw))
+        key = len(imgs), max(x[4] for x in boxes), max(x[5] for x in boxes)
+        if key not in self.host:
+            self.host[key] = [torch.empty(key + (3,), dtype=torch.uint8, pin_memory=self.pin) for _ in range(self.slots)]
+        slot, self.i = self.i % self.slots, self.i + 1
+        buf = self.host[key][slot].numpy()
+        buf.fill(114)
+        for img, b, (w, h, top, left, _, _) in zip(imgs, buf, boxes):
+            roi = b[top:top + h, left:left + w]
+            if img.shape[:2] != (h, w):
+                cv2.resize(img, (w, h), dst=roi, interpolation=cv2.INTER_LINEAR)
+            else:
+                roi[:] = img
+        return (key, slot), [x[4:6] for x in boxes]
+
+    def to_device(self, key, slot):
+        # Normalized (b,3,h,w) RGB device tensor of a slot, valid until the next call with the same batch shape
+        if key not in self.dev:
+            x = torch.empty(key + (3,), dtype=torch.uint8, device=self.device) if self.pin else None
+            self.dev[key] = x, torch.empty((key[0], 3) + key[1:], dtype=self.dtype, device=self.device)
+        x, out = self.dev[key]
+        if x is None:  # cpu, use the host buffer directly
+            x = self.host[key][slot]
+        else:
+            x.copy_(self.host[key][slot], non_blocking=True)
+        for c in range(3):  # BGR HWC uint8 to RGB CHW 0.0-1.0
+            torch.mul(x[..., 2 - c], 1 / 255, out=out[:, c])
+        return out
+
+
 def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
                        border=(0, 0)):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
@@ -1103,6 +1943,172 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
     return img, targets
 
 
+class BatchAugment:
+    """ Mosaic, mixup, random perspective, HSV and flip augmentation of whole collated uint8 batches
+
+    Used as the DataLoader collate_fn in place of the per-sample load_mosaic() / random_perspective() / augment_hsv()
+    path, so each worker warps a batch with one F.grid_sample() per image and transforms all labels at once. Mosaic
+    tiles are drawn from the same batch, boxes are warped instead of segments, and load_mosaic9(), copy_paste() and
+    pastein() are not applied.
+    """
+
+    def __init__(self, hyp, img_size=640, mosaic=True):
+        self.hyp = hyp
+        self.s = img_size
+        self.mosaic = hyp['mosaic'] if mosaic else 0.0  # mosaic probability
+
+    def __call__(self, batch):
+        img, labels, path, shapes = LoadImagesAndLabels.collate_fn(batch)
+        img, labels = self.augment(img, labels, shapes)
+        return img, labels, path, (None,) * len(path)
+
+    def augment(self, img, labels, shapes):
+        # img (b,3,s,s) uint8 RGB with images at the top-left, labels (n,6) image,class,xyxy pixels, shapes (h,w) each
+        hyp, s, b = self.hyp, self.s, img.shape[0]
+        mosaic = torch.rand(b) < self.mosaic
+        canvas, labels = self.assemble(img, labels, shapes, mosaic)
+        M, scale = self.random_perspective(b)
+        img = self.warp(canvas, M)
+        labels = self.warp_labels(labels, M, scale)
+
+        # MixUp https://arxiv.org/pdf/1710.09412.pdf
+        mix = mosaic & (torch.rand(b) < hyp['mixup'])
+        if mix.any() and b > 1:
+            p = torch.randperm(b)
+            j = torch.empty_like(p)
+            j[p] = p.roll(-1)  # partner of each image, a random cycle so never the image itself
+            r = torch.from_numpy(np.random.beta(8.0, 8.0, b)).float().view(-1, 1, 1, 1)  # mixup ratio, alpha=beta=8.0
+            img = torch.where(mix.view(-1, 1, 1, 1), img * r + img[j] * (1 - r), img)
+            jinv = torch.argsort(j)  # image that receives the labels of each partner
+            extra = labels[mix[jinv[labels[:, 0].long()]]].clone()
+            extra[:, 0] = jinv[extra[:, 0].long()].float()
+            labels = torch.cat((labels, extra), 0)
+
+        img = self.augment_hsv(img)
+
+        # Flip up-down, left-right
+        for k, dim, (a, c) in ('flipud', 2, (3, 5)), ('fliplr', 3, (2, 4)):
+            f = torch.rand(b) < hyp[k]
+            img = torch.where(f.view(-1, 1, 1, 1), img.flip(dim), img)
+            i = f[labels[:, 0].long()]
+            labels[i, a], labels[i, c] = s - labels[i, c], s - labels[i, a]
+
+        labels[:, 2:] = xyxy2xywh(labels[:, 2:]) / s  # pixel xyxy to normalized xywh
+        return img.round_().clamp_(0, 255).to(torch.uint8), labels
+
+    def assemble(self, img, labels, shapes, mosaic):
+        # Place each image, or a 4-mosaic of batch images, into a 2s x 2s canvas centered on (s, s) as in load_mosaic()
+        s, b = self.s, img.shape[0]
+        canvas = torch.full((b, 3, 2 * s, 2 * s), 114, dtype=torch.uint8)
+        lb = [labels[labels[:, 0] == i, 1:] for i in range(b)]
+        out = []
+        for i in range(b):
+            if not mosaic[i]:  # single image, letterboxed to the canvas center
+                h, w = shapes[i]
+                x, y = s - w // 2, s - h // 2
+                canvas[i, :, y:y + h, x:x + w] = img[i, :, :h, :w]
+                out.append(torch.cat((torch.full((len(lb[i]), 1), i), lb[i] + torch.tensor([0, x, y, x, y])), 1))
+                continue
+            yc, xc = [int(random.uniform(s // 2, 3 * s // 2)) for _ in range(2)]  # mosaic center x, y
+            for k, j in enumerate([i] + random.choices(range(b), k=3)):  # 3 additional batch images
+                h, w = shapes[j]
+                if k == 0:  # top left
+                    x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc
+                    x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h
+                elif k == 1:  # top right
+                    x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
+                    x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
+                elif k == 2:  # bottom left
+                    x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
+                    x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
+                else:  # bottom right
+                    x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
+                    x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
+                canvas[i, :, y1a:y2a, x1a:x2a] = img[j, :, y1b:y2b, x1b:x2b]
+                padw, padh = x1a - x1b, y1a - y1b
+                l = lb[j] + torch.tensor([0, padw, padh, padw, padh])
+                l[:, 1:].clamp_(0, 2 * s)  # clip when using random_perspective()
+                out.append(torch.cat((torch.full((len(l), 1), i), l), 1))
+        return canvas, torch.cat(out, 0)
+
+    def random_perspective(self, b):
+        # Random canvas-to-output perspective matrices (b,3,3) and scales (b,), as in random_perspective()
+        hyp, s = self.hyp, self.s
+        u = lambda a: (torch.rand(b) * 2 - 1) * a  # uniform(-a, a)
+        M = [torch.eye(3).repeat(b, 1, 1) for _ in range(5)]
+        C, P, R, S, T = M
+        C[:, 0, 2] = C[:, 1, 2] = -s  # center
+        P[:, 2, 0], P[:, 2, 1] = u(hyp['perspective']), u(hyp['perspective'])  # perspective
+        a = u(hyp['degrees']) * math.pi / 180  # rotation
+        scale = torch.rand(b) * (0.1 + 2 * hyp['scale']) + 1 - hyp['scale']  # uniform(1 - scale, 1.1 + scale)
+        R[:, 0, 0] = R[:, 1, 1] = scale * torch.cos(a)
+        R[:, 0, 1], R[:, 1, 0] = scale * torch.sin(a), -scale * torch.sin(a)
+        S[:, 0, 1], S[:, 1, 0] = torch.tan(u(hyp['shear']) * math.pi / 180), torch.tan(u(hyp['shear']) * math.pi / 180)
+        T[:, 0, 2], T[:, 1, 2] = (0.5 + u(hyp['translate'])) * s, (0.5 + u(hyp['translate'])) * s  # translation
+        return T @ S @ R @ P @ C, scale  # order of operations (right to left) is IMPORTANT
+
+    def warp(self, canvas, M):
+        # Sample the s x s outputs from the 2s x 2s canvases through the inverse of M, padding with 114
+        s, n = self.s, canvas.shape[-1]
+        y, x = torch.meshgrid([torch.arange(s), torch.arange(s)])
+        xy = torch.stack((x, y, torch.ones_like(x)), -1).float().view(-1, 3)  # output pixel coordinates
+        xy = xy @ torch.inverse(M).transpose(1, 2)  # canvas coordinates
+        grid = (xy[..., :2] / xy[..., 2:] / (n - 1) * 2 - 1).view(-1, s, s, 2)
+        img = torch.empty((len(canvas), 3, s, s))
+        for i in range(len(canvas)):  # per image to bound float memory
+            img[i] = F.grid_sample(canvas[i:i + 1].float() - 114, grid[i:i + 1], align_corners=True)[0] + 114
+        return img
+
+    def warp_labels(self, labels, M, scale):
+        # Warp box corners of all labels with the matrix of their image, clip and filter candidates
+        s, n = self.s, len(labels)
+        if not n:
+            return labels
+        i = labels[:, 0].long()
+        xy = torch.ones((n, 4, 3))
+        xy[..., :2] = labels[:, [2, 3, 4, 5, 2, 5, 4, 3]].view(n, 4, 2)  # x1y1, x2y2, x1y2, x2y1
+        xy = xy @ M[i].transpose(1, 2)  # transform
+        xy = xy[..., :2] / xy[..., 2:]  # perspective rescale or affine
+        new = torch.cat((xy.min(1)[0], xy.max(1)[0]), 1).clamp(0, s)  # new boxes, clipped
+        box1 = labels[:, 2:].T * scale[i]
+        keep = box_candidates(box1=box1.numpy(), box2=new.T.numpy())
+        labels = labels[torch.from_numpy(keep)]
+        labels[:, 2:] = new[torch.from_numpy(keep)]
+        return labels
+
+    def augment_hsv(self, img):
+        # HSV gains as in augment_hsv() on RGB float images
+        hyp, b = self.hyp, img.shape[0]
+        r = (torch.rand(b, 3) * 2 - 1) * torch.tensor([hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v']]) + 1  # random gains
+        h, sat, v = rgb2hsv(img / 255)
+        h = (h * r[:, 0].view(-1, 1, 1)) % 1.0
+        sat = (sat * r[:, 1].view(-1, 1, 1)).clamp_(0, 1)
+        v = (v * r[:, 2].view(-1, 1, 1)).clamp_(0, 1)
+        return hsv2rgb(h, sat, v) * 255
+
+
+def rgb2hsv(x):
+    # (b,3,h,w) RGB in [0, 1] to hue, saturation, value (b,h,w) in [0, 1]
+    r, g, b = x.unbind(1)
+    maxc, minc = x.max(1)[0], x.min(1)[0]
+    delta = maxc - minc
+    d = delta.clamp(min=1e-8)
+    rc, gc, bc = (maxc - r) / d, (maxc - g) / d, (maxc - b) / d
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta > 0, (h / 6.0) % 1.0, torch.zeros_like(h))
+    return h, delta / maxc.clamp(min=1e-8), maxc
+
+
+def hsv2rgb(h, s, v):
+    # hue, saturation, value (b,h,w) in [0, 1] to (b,3,h,w) RGB in [0, 1]
+    i = torch.floor(h * 6)
+    f = h * 6 - i
+    i = (i.long() % 6).unsqueeze(0)
+    p, q, t = v * (1 - s), v * (1 - s * f), v * (1 - s * (1 - f))
+    rgb = [torch.stack(x).gather(0, i)[0] for x in ((v, q, p, p, t, v), (t, v, v, q, p, p), (p, p, t, v, v, q))]
+    return torch.stack(rgb, 1)
+
+
 def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):  # box1(4,n), box2(4,n)
     # Compute candidate boxes: box1 before augment, box2 after augment, wh_thr (pixels), aspect_ratio_thr, area_ratio
     w1, h1 = box1[2] - box1[0], box1[3] - box1[1]
@@ -1112,7 +2118,9 @@ def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):  #
 
 
 def bbox_ioa(box1, box2):
-    # Returns the intersection over box2 area given box1, box2. box1 is 4, box2 is nx4. boxes are x1y1x2y2
+    # Returns the intersection over box2 area given box1, box2. box1 is 4 or nx4, box2 is mx4, returns m or nxm.
+    # boxes are x1y1x2y2
+    box1 = np.asarray(box1).T[..., None]  # 4x1 or 4xnx1, broadcasts against the m boxes of box2
     box2 = box2.transpose()
 
     # Get the coordinates of bounding boxes
@@ -1128,7 +2136,7 @@ def bbox_ioa(box1, box2):
 
     # Intersection over box2 area
     return inter_area / box2_area
-    
+
 
 def cutout(image, labels):
     # Applies image cutout augmentation https://arxiv.org/abs/1708.04552
@@ -1159,62 +2167,56 @@ def cutout(image, labels):
     
 
 def pastein(image, labels, sample_labels, sample_images, sample_masks):
-    # Applies image cutout augmentation https://arxiv.org/abs/1708.04552
+    # Pastes random instance crops into random boxes that obscure existing labels by less than 30%. All candidate boxes
+    # are drawn at once and checked against the labels with one bbox_ioa() call
     h, w = image.shape[:2]
+    if not len(sample_labels):
+        return labels
 
     # create random masks
-    scales = [0.75] * 2 + [0.5] * 4 + [0.25] * 4 + [0.125] * 4 + [0.0625] * 6  # image size fraction
-    for s in scales:
-        if random.random() < 0.2:
+    scales = np.array([0.75] * 2 + [0.5] * 4 + [0.25] * 4 + [0.125] * 4 + [0.0625] * 6)  # image size fraction
+    scales = scales[np.random.rand(len(scales)) >= 0.2]
+    n = len(scales)
+    mask_h = (np.random.rand(n) * (h * scales).astype(int)).astype(int) + 1
+    mask_w = (np.random.rand(n) * (w * scales).astype(int)).astype(int) + 1
+
+    # box
+    xmin = np.maximum(0, np.random.randint(0, w + 1, n) - mask_w // 2)
+    ymin = np.maximum(0, np.random.randint(0, h + 1, n) - mask_h // 2)
+    xmax = np.minimum(w, xmin + mask_w)
+    ymax = np.minimum(h, ymin + mask_h)
+    box = np.stack((xmin, ymin, xmax, ymax), 1).astype(np.float32)
+
+    # instance of each box, resized to fit it
+    sel = np.random.randint(0, len(sample_labels), n)
+    hs, ws = np.array([sample_images[i].shape[:2] for i in sel]).reshape(-1, 2).T
+    r_scale = np.minimum((ymax - ymin) / hs, (xmax - xmin) / ws)
+    r_w, r_h = (ws * r_scale).astype(int), (hs * r_scale).astype(int)
+    pasted = np.stack((xmin, ymin, xmin + r_w, ymin + r_h), 1).astype(np.float32)
+
+    ok = (xmax > xmin + 20) & (ymax > ymin + 20) & (r_w > 10) & (r_h > 10)
+    if len(labels):
+        ok &= (bbox_ioa(box, labels[:, 1:5]) < 0.30).all(1)  # allow 30% obscuration of existing labels
+    ioa = bbox_ioa(box, pasted)  # and of instances pasted by earlier boxes
+    keep = []
+    for i in np.nonzero(ok)[0]:
+        if keep and (ioa[i, keep] >= 0.30).any():
             continue
-        mask_h = random.randint(1, int(h * s))
-        mask_w = random.randint(1, int(w * s))
-
-        # box
-        xmin = max(0, random.randint(0, w) - mask_w // 2)
-        ymin = max(0, random.randint(0, h) - mask_h // 2)
-        xmax = min(w, xmin + mask_w)
-        ymax = min(h, ymin + mask_h)   
-        
-        box = np.array([xmin, ymin, xmax, ymax], dtype=np.float32)
-        if len(labels):
-            ioa = bbox_ioa(box, labels[:, 1:5])  # intersection over area     
-        else:
-            ioa = np.zeros(1)
-        
-        if (ioa < 0.30).all() and len(sample_labels) and (xmax > xmin+20) and (ymax > ymin+20):  # allow 30% obscuration of existing labels
-            sel_ind = random.randint(0, len(sample_labels)-1)
-            #print(len(sample_labels))
-            #print(sel_ind)
-            #print((xmax-xmin, ymax-ymin))
-            #print(image[ymin:ymax, xmin:xmax].shape)
-            #print([[sample_labels[sel_ind], *box]])
-            #print(labels.shape)
-            hs, ws, cs = sample_images[sel_ind].shape
-            r_scale = min((ymax-ymin)/hs, (xmax-xmin)/ws)
-            r_w = int(ws*r_scale)
-            r_h = int(hs*r_scale)
-            
-            if (r_w > 10) and (r_h > 10):
-                r_mask = cv2.resize(sample_masks[sel_ind], (r_w, r_h))
-                r_image = cv2.resize(sample_images[sel_ind], (r_w, r_h))
-                temp_crop = image[ymin:ymin+r_h, xmin:xmin+r_w]
-                m_ind = r_mask > 0
-                if m_ind.astype(np.int32).sum() > 60:
-                    temp_crop[m_ind] = r_image[m_ind]
-                    #print(sample_labels[sel_ind])
-                    #print(sample_images[sel_ind].shape)
-                    #print(temp_crop.shape)
-                    box = np.array([xmin, ymin, xmin+r_w, ymin+r_h], dtype=np.float32)
-                    if len(labels):
-                        labels = np.concatenate((labels, [[sample_labels[sel_ind], *box]]), 0)
-                    else:
-                        labels = np.array([[sample_labels[sel_ind], *box]])
-                              
-                    image[ymin:ymin+r_h, xmin:xmin+r_w] = temp_crop
+        x1, y1, x2, y2 = pasted[i].astype(int)
+        r_mask = cv2.resize(sample_masks[sel[i]], (x2 - x1, y2 - y1))
+        m_ind = r_mask.reshape(y2 - y1, x2 - x1, -1).any(2)  # pixels to paste
+        if m_ind.sum() > 20:
+            r_image = cv2.resize(sample_images[sel[i]], (x2 - x1, y2 - y1))
+            image[y1:y2, x1:x2][m_ind] = r_image[m_ind]
+            keep.append(i)
+
+    if keep:
+        new = np.concatenate((np.array([sample_labels[i] for i in sel[keep]]).reshape(-1, 1), pasted[keep]), 1)
+        labels = np.concatenate((labels.reshape(-1, 5), new), 0) if len(labels) else new
 
     return labels
 
+
 class Albumentations:
     # YOLOv5 Albumentations class (optional, only used if package is installed)
     def __init__(self):
@@ -1313,6 +2315,20 @@ def autosplit(path='../coco', weights=(0.9, 0.1, 0.0), annotated_only=False):
                 f.write(str(img) + '\n')  # add image to txt file
     
     
+def profile_decode(path='../coco/images/val2017', img_size=640, n=200):
+    """ Print per-image load_image() time (decode + resize) of each decode backend
+    Usage: from utils.datasets import *; profile_decode('../coco/images/val2017', 640)
+    """
+    dataset = LoadImagesAndLabels(path, img_size)
+    n = min(n, dataset.n)
+    for decode in 'cv2', 'reduced':
+        dataset.decode = decode
+        t = time.time()
+        for i in range(n):
+            load_image(dataset, i)
+        print(f'{decode:>10s}: {(time.time() - t) / n * 1E3:.2f} ms/image ({n} images at {img_size})')
+
+
 def load_segmentations(self, index):
     key = '/work/handsomejw66/coco17/' + self.img_files[index]
     #print(key)
@@ -606,13 +606,17 @@ def box_diou(box1, box2, eps: float = 1e-7):
 
 
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=()):
+                        labels=(), mode='nms'):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
+    mode is 'nms' (standard), 'merge' (kept boxes become the score-weighted mean of the boxes they suppress) or 'soft'
+    (Gaussian Soft-NMS, overlapping scores are decayed instead of removed, iou_thres is not used).
+
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
 
+    assert mode in ('nms', 'merge', 'soft'), f'Invalid NMS mode {mode}, valid modes are nms, merge, soft'
     nc = prediction.shape[2] - 5  # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
 
@@ -623,7 +627,6 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
     t = time.time()
     output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
@@ -681,16 +684,14 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
         # Batched NMS
         c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
         boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
+        if mode == 'soft':  # Soft-NMS
+            i, x[:, 4] = soft_nms(boxes, scores, conf_thres, max_det)
+        else:
+            i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
+            if i.shape[0] > max_det:  # limit detections
+                i = i[:max_det]
+            if mode == 'merge' and n > 1:  # Merge NMS (boxes merged using weighted mean)
+                i = merge_nms(x, boxes, i, iou_thres, redundant)
 
         output[xi] = x[i]
         if (time.time() - t) > time_limit:
@@ -700,13 +701,170 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def non_max_suppression_batched(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, labels=(), max_det=300, mode='nms'):
+    """Runs Non-Maximum Suppression (NMS) on a whole batch of inference results without a per-image loop
+
+    Candidates of all images are filtered, scored and sorted together. On CUDA boxes are offset by image as well as
+    class (in float64 to keep their precision) so one torchvision.ops.nms() call serves the whole batch; on CPU the
+    kernel cost grows with the boxes in the call, so it runs once per image slice instead. max_det is applied per
+    image by ranking the kept boxes within their image. Detections match non_max_suppression() up to the order of
+    equal scores. The 'merge' and 'soft' modes run per image slice on any device.
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    assert mode in ('nms', 'merge', 'soft'), f'Invalid NMS mode {mode}, valid modes are nms, merge, soft'
+    bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes per image into NMS
+    multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
+
+    b, k = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # image, anchor of candidates
+    x = prediction[b, k]
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(l) for l in labels):
+        l = torch.cat([torch.cat((torch.full((len(l), 1), i, device=l.device), l), 1) for i, l in enumerate(labels)], 0)
+        v = torch.zeros((len(l), nc + 5), device=x.device)
+        v[:, :4] = l[:, 2:6]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(l)), l[:, 1].long() + 5] = 1.0  # cls
+        x, b = torch.cat((x, v), 0), torch.cat((b, l[:, 0].long().to(b.device)), 0)
+
+    # Compute conf
+    if nc == 1:
+        x[:, 5:] = x[:, 4:5]  # for models with one class, cls_conf is always 0.5
+    else:
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, b = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float()), 1)[i], b[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[i], b[i]
+
+    # Sort by image, then by confidence within each image, and keep at most max_nms boxes per image
+    i = x[:, 4].argsort(descending=True)
+    i = i[stable_argsort(b[i])]
+    x, b = x[i], b[i]
+    counts = torch.bincount(b, minlength=bs)
+    if counts.max() > max_nms:  # excess boxes
+        i = rank_in_segments(counts) < max_nms
+        x, b, counts = x[i], b[i], counts.clamp(max=max_nms)
+
+    # Batched NMS
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+    if x.is_cuda and mode == 'nms':  # one call for the whole batch, boxes also offset by image
+        boxes = boxes.double() + b[:, None].double() * (max_wh * (nc + 1))
+        i = torchvision.ops.nms(boxes, scores.double(), iou_thres)  # sorted by decreasing score
+        i = i[stable_argsort(b[i])]  # by image, decreasing score within each
+    else:  # CPU NMS scales with boxes kept x boxes in the call, so run it on each image slice
+        i, j = [b[:0]], torch.cumsum(counts, 0).tolist()
+        for s, e in zip([0] + j[:-1], j):
+            if mode == 'soft':
+                k, x[s:e, 4] = soft_nms(boxes[s:e], scores[s:e], conf_thres, max_det)
+            else:
+                k = torchvision.ops.nms(boxes[s:e], scores[s:e], iou_thres)[:max_det]
+                if mode == 'merge' and e - s > 1:
+                    k = merge_nms(x[s:e], boxes[s:e], k, iou_thres)
+            i.append(k + s)
+        i = torch.cat(i)
+    counts = torch.bincount(b[i], minlength=bs)
+    keep = rank_in_segments(counts) < max_det  # limit detections per image
+    x, counts = x[i[keep]], torch.bincount(b[i[keep]], minlength=bs)
+    return list(x.split(counts.tolist()))
+
+
+def stable_argsort(x):
+    # Stable ascending argsort of an integer tensor by a unique key, argsort(stable=True) needs torch>=1.13
+    return (x.long() * len(x) + torch.arange(len(x), device=x.device)).argsort()
+
+
+def rank_in_segments(counts):
+    # Position of each element within its segment, for segments of the given lengths laid out consecutively
+    starts = torch.cumsum(counts, 0) - counts
+    return torch.arange(int(counts.sum()), device=counts.device) - starts.repeat_interleave(counts)
+
+
+def merge_nms(x, boxes, i, iou_thres, redundant=True, tile=4096):
+    # Merge-NMS: update x(n,6) boxes of kept indices i to the score-weighted mean of the boxes(n,4) they overlap
+    # boxes(i,4) = weights(i,n) * boxes(n,4), with weights built on tiles of candidates to bound memory by len(i) x tile
+    xy, w, m = torch.zeros((len(i), 4), device=x.device), torch.zeros((len(i), 1), device=x.device), 0
+    for s in range(0, len(boxes), tile):
+        iou = box_iou(boxes[i], boxes[s:s + tile]) > iou_thres  # iou tile
+        weights = iou * x[s:s + tile, 4]  # box weights
+        xy += torch.mm(weights, x[s:s + tile, :4])
+        w += weights.sum(1, keepdim=True)
+        m += iou.sum(1)  # overlapping boxes, including itself
+    x[i, :4] = xy / w  # merged boxes
+    return i[m > 1] if redundant else i  # require redundancy
+
+
+def soft_nms(boxes, scores, conf_thres, max_det, sigma=0.5):
+    # Gaussian Soft-NMS: take the highest score, decay the others by exp(-iou^2 / sigma), repeat up to max_det times
+    # Returns kept indices and the full scores vector with decayed values, IoU is one boxes(n) row per kept box
+    s, decayed = scores.clone(), scores.clone()
+    i = []
+    for _ in range(min(max_det, len(boxes))):
+        k = s.argmax()
+        if s[k] <= conf_thres:
+            break
+        i.append(k)
+        decayed[k] = s[k]
+        s *= torch.exp(-box_iou(boxes[k, None], boxes)[0] ** 2 / sigma)
+        s[k] = -1  # taken
+    return torch.stack(i) if i else torch.zeros(0, dtype=torch.long, device=boxes.device), decayed
+
+
+def profile_nms(batch_size=64, n=25200, nc=80, conf_thres=0.001, iou_thres=0.65, multi_label=True, modes=('nms',),
+                device='', runs=5):
+    # Time non_max_suppression() against non_max_suppression_batched() on random predictions of n anchors per image
+    # Usage: from utils.general import *; profile_nms(modes=('nms', 'merge', 'soft'))
+    from utils.torch_utils import select_device, time_synchronized
+    device = select_device(device)
+    torch.manual_seed(0)
+    p = torch.rand(batch_size, n, nc + 5, device=device)
+    p[..., :2] *= 640  # xy
+    p[..., 2:4] = p[..., 2:4] * 100 + 4  # wh
+    p[..., 4] *= torch.rand(batch_size, n, device=device) < 0.01  # objects at 1% of anchors
+    p[..., 5:] = p[..., 5:] ** 64  # peaked class scores
+    for mode in modes:
+        for f in non_max_suppression, non_max_suppression_batched:
+            f(p.clone(), conf_thres, iou_thres, multi_label=multi_label, mode=mode)  # warmup
+            dt = 0.0
+            for _ in range(runs):
+                x = p.clone()  # predictions are modified in place
+                t = time_synchronized()
+                out = f(x, conf_thres, iou_thres, multi_label=multi_label, mode=mode)
+                dt += (time_synchronized() - t) / runs
+            print(f'{f.__name__:>28} {mode:>5}: {dt * 1E3:8.1f} ms per batch of {batch_size}, '
+                  f'{sum(len(x) for x in out)} detections')
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=(), kpt_label=False, nc=None, nkpt=None):
+                        labels=(), kpt_label=False, nc=None, nkpt=None, mode='nms'):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
+    mode is 'nms', 'merge' or 'soft', as in non_max_suppression()
+
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
+    assert mode in ('nms', 'merge', 'soft'), f'Invalid NMS mode {mode}, valid modes are nms, merge, soft'
     if nc is None:
         nc = prediction.shape[2] - 5  if not kpt_label else prediction.shape[2] - 56 # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
@@ -718,7 +876,6 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
     t = time.time()
     output = [torch.zeros((0,6), device=prediction.device)] * prediction.shape[0]
@@ -778,16 +935,14 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
         # Batched NMS
         c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
         boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
+        if mode == 'soft':  # Soft-NMS
+            i, x[:, 4] = soft_nms(boxes, scores, conf_thres, max_det)
+        else:
+            i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
+            if i.shape[0] > max_det:  # limit detections
+                i = i[:max_det]
+            if mode == 'merge' and n > 1:  # Merge NMS (boxes merged using weighted mean)
+                i = merge_nms(x, boxes, i, iou_thres, redundant)
 
         output[xi] = x[i]
         if (time.time() - t) > time_limit:
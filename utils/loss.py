@@ -1,10 +1,13 @@
 # Loss functions
 
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from utils.general import bbox_iou, bbox_alpha_iou, box_iou, box_giou, box_diou, box_ciou, xywh2xyxy
+from utils.general import bbox_iou, bbox_alpha_iou, box_iou, box_giou, box_diou, box_ciou, xywh2xyxy, \
+    rank_in_segments, stable_argsort
 from utils.torch_utils import is_parallel
 
 
@@ -177,7 +180,7 @@ class RankSort(torch.autograd.Function):
     @staticmethod
     def forward(ctx, logits, targets, delta_RS=0.50, eps=1e-10): 
 
-        classification_grads=torch.zeros(logits.shape).cuda()
+        classification_grads=torch.zeros(logits.shape, device=logits.device)
         
         #Filter fg logits
         fg_labels = (targets > 0.)
@@ -191,10 +194,10 @@ class RankSort(torch.autograd.Function):
         relevant_bg_labels=((targets==0) & (logits>=threshold_logit))
         
         relevant_bg_logits = logits[relevant_bg_labels] 
-        relevant_bg_grad=torch.zeros(len(relevant_bg_logits)).cuda()
-        sorting_error=torch.zeros(fg_num).cuda()
-        ranking_error=torch.zeros(fg_num).cuda()
-        fg_grad=torch.zeros(fg_num).cuda()
+        relevant_bg_grad=torch.zeros(len(relevant_bg_logits), device=logits.device)
+        sorting_error=torch.zeros(fg_num, device=logits.device)
+        ranking_error=torch.zeros(fg_num, device=logits.device)
+        fg_grad=torch.zeros(fg_num, device=logits.device)
         
         #sort the fg logits
         order=torch.argsort(fg_logits)
@@ -275,7 +278,7 @@ class RankSort(torch.autograd.Function):
 class aLRPLoss(torch.autograd.Function):
     @staticmethod
     def forward(ctx, logits, targets, regression_losses, delta=1., eps=1e-5): 
-        classification_grads=torch.zeros(logits.shape).cuda()
+        classification_grads=torch.zeros(logits.shape, device=logits.device)
         
         #Filter fg logits
         fg_labels = (targets == 1)
@@ -289,10 +292,10 @@ class aLRPLoss(torch.autograd.Function):
         #Get valid bg logits
         relevant_bg_labels=((targets==0)&(logits>=threshold_logit))
         relevant_bg_logits=logits[relevant_bg_labels] 
-        relevant_bg_grad=torch.zeros(len(relevant_bg_logits)).cuda()
-        rank=torch.zeros(fg_num).cuda()
-        prec=torch.zeros(fg_num).cuda()
-        fg_grad=torch.zeros(fg_num).cuda()
+        relevant_bg_grad=torch.zeros(len(relevant_bg_logits), device=logits.device)
+        rank=torch.zeros(fg_num, device=logits.device)
+        prec=torch.zeros(fg_num, device=logits.device)
+        fg_grad=torch.zeros(fg_num, device=logits.device)
         
         max_prec=0                                           
         #sort the fg logits
@@ -345,7 +348,7 @@ class aLRPLoss(torch.autograd.Function):
 class APLoss(torch.autograd.Function):
     @staticmethod
     def forward(ctx, logits, targets, delta=1.): 
-        classification_grads=torch.zeros(logits.shape).cuda()
+        classification_grads=torch.zeros(logits.shape, device=logits.device)
         
         #Filter fg logits
         fg_labels = (targets == 1)
@@ -359,10 +362,10 @@ class APLoss(torch.autograd.Function):
         #Get valid bg logits
         relevant_bg_labels=((targets==0)&(logits>=threshold_logit))
         relevant_bg_logits=logits[relevant_bg_labels] 
-        relevant_bg_grad=torch.zeros(len(relevant_bg_logits)).cuda()
-        rank=torch.zeros(fg_num).cuda()
-        prec=torch.zeros(fg_num).cuda()
-        fg_grad=torch.zeros(fg_num).cuda()
+        relevant_bg_grad=torch.zeros(len(relevant_bg_logits), device=logits.device)
+        rank=torch.zeros(fg_num, device=logits.device)
+        prec=torch.zeros(fg_num, device=logits.device)
+        fg_grad=torch.zeros(fg_num, device=logits.device)
         
         max_prec=0                                           
         #sort the fg logits
@@ -419,6 +422,52 @@ class APLoss(torch.autograd.Function):
         return g1*out_grad1, None, None
 
 
+class TargetCandidates:
+    # Anchor-matched grid candidates of targets on each detection layer, shared by build_targets() and find_*_positive()
+    def __init__(self, anchors, anchor_t, g=0.5):
+        self.anchors, self.anchor_t, self.g = anchors, anchor_t, g  # anchors (nl, na, 2) in grid units, bias
+        self.off = torch.tensor([[0, 0],
+                                 [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
+                                 # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
+                                 ], device=anchors.device).float() * g  # offsets
+        self.gains = {}  # xyxy gain per grid shape
+
+    def __call__(self, shapes, targets):
+        # Candidates per layer of grid shapes (ny, nx) as (target index, anchor index, grid xywh, grid ij), input
+        # targets(image,class,x,y,w,h). Ordered by offset, anchor, target as the former (5, na, nt) target repeats
+        g, out = self.g, []
+        for (ny, nx), anchors in zip(shapes, self.anchors):
+            gain = self.gains.get((ny, nx))
+            if gain is None:
+                gain = self.gains[(ny, nx)] = torch.tensor([nx, ny, nx, ny], device=targets.device).float()
+            gxywh = targets[:, 2:6] * gain  # grid xywh
+
+            # Match targets to anchors
+            r = gxywh[None, :, 2:4] / anchors[:, None]  # wh ratio
+            ja = torch.max(r, 1. / r).max(2)[0] < self.anchor_t  # (na, nt)
+
+            # Offsets
+            gxy = gxywh[:, :2]  # grid xy
+            gxi = gain[:2] - gxy  # inverse
+            j, k = ((gxy % 1. < g) & (gxy > 1.)).T
+            l, m = ((gxi % 1. < g) & (gxi > 1.)).T
+            jo = torch.stack((torch.ones_like(j), j, k, l, m))  # (5, nt)
+            o, a, ti = (jo[:, None] & ja[None]).nonzero(as_tuple=True)
+            gxywh = gxywh[ti]
+            out.append((ti, a, gxywh, (gxywh[:, :2] - self.off[o]).long()))
+        return out
+
+    def positives(self, shapes, targets):
+        # Candidates as find_*_positive() returns them, [(image, anchor, gj, gi)] and [anchors] per layer
+        indices, anch = [], []
+        for (ny, nx), anchors, (ti, a, _, gij) in zip(shapes, self.anchors, self(shapes, targets)):
+            b = targets[ti, 0].long()  # image index
+            gi, gj = gij.T  # grid xy indices
+            indices.append((b, a, gj.clamp_(0, ny - 1), gi.clamp_(0, nx - 1)))
+            anch.append(anchors[a])  # anchors
+        return indices, anch
+
+
 class ComputeLoss:
     # Compute losses
     def __init__(self, model, autobalance=False):
@@ -446,6 +495,7 @@ class ComputeLoss:
         self.BCEcls, self.BCEobj, self.gr, self.hyp, self.autobalance = BCEcls, BCEobj, model.gr, h, autobalance
         for k in 'na', 'nc', 'nl', 'anchors':
             setattr(self, k, getattr(det, k))
+        self.candidates = TargetCandidates(self.anchors, h['anchor_t'])  # grid candidates of targets
 
     def __call__(self, p, targets):  # predictions, targets, model
         device = targets.device
@@ -499,60 +549,31 @@ class ComputeLoss:
 
     def build_targets(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
-        na, nt = self.na, targets.shape[0]  # number of anchors, targets
         tcls, tbox, indices, anch = [], [], [], []
-        gain = torch.ones(7, device=targets.device).long()  # normalized to gridspace gain
-        ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
-        targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
-
-        g = 0.5  # bias
-        off = torch.tensor([[0, 0],
-                            [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
-                            # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-                            ], device=targets.device).float() * g  # offsets
-
-        for i in range(self.nl):
-            anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain
-            if nt:
-                # Matches
-                r = t[:, :, 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1. / r).max(2)[0] < self.hyp['anchor_t']  # compare
-                # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1. < g) & (gxy > 1.)).T
-                l, m = ((gxi % 1. < g) & (gxi > 1.)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            b, c = t[:, :2].long().T  # image, class
-            gxy = t[:, 2:4]  # grid xy
-            gwh = t[:, 4:6]  # grid wh
-            gij = (gxy - offsets).long()
+        for i, (ti, a, gxywh, gij) in enumerate(self.candidates([pi.shape[2:4] for pi in p], targets)):
+            b, c = targets[ti, :2].long().T  # image, class
             gi, gj = gij.T  # grid xy indices
 
             # Append
-            a = t[:, 6].long()  # anchor indices
-            indices.append((b, a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1)))  # image, anchor, grid indices
-            tbox.append(torch.cat((gxy - gij, gwh), 1))  # box
-            anch.append(anchors[a])  # anchors
+            indices.append((b, a, gj.clamp_(0, p[i].shape[2] - 1), gi.clamp_(0, p[i].shape[3] - 1)))
+            tbox.append(torch.cat((gxywh[:, :2] - gij, gxywh[:, 2:]), 1))  # box
+            anch.append(self.anchors[i][a])  # anchors
             tcls.append(c)  # class
 
         return tcls, tbox, indices, anch
 
 
+def ota_cls_cost(p_cls, p_obj, gt_cls):
+    # SimOTA pairwise class cost (..., num_gt, N) of candidate logits p_cls (..., N, nc), p_obj (..., N, 1) against
+    # GT classes gt_cls (..., num_gt). BCE against a one-hot target is the all-negative BCE summed over classes plus
+    # the GT class term, BCE(x, 1) - BCE(x, 0) = -x, so the (num_gt, N, nc) one-hot expansion is never built
+    y = (p_cls.float().sigmoid() * p_obj.float().sigmoid()).sqrt_()
+    logits = torch.log(y / (1 - y))
+    cls_neg = F.binary_cross_entropy_with_logits(logits, torch.zeros_like(logits), reduction="none").sum(-1)
+    cls_pos = logits.gather(-1, gt_cls[..., None, :].expand(*logits.shape[:-1], gt_cls.shape[-1]))  # (..., N, num_gt)
+    return cls_neg[..., None, :] - cls_pos.transpose(-1, -2)
+
+
 class ComputeLossOTA:
     # Compute losses
     def __init__(self, model, autobalance=False):
@@ -578,11 +599,14 @@ class ComputeLossOTA:
         self.BCEcls, self.BCEobj, self.gr, self.hyp, self.autobalance = BCEcls, BCEobj, model.gr, h, autobalance
         for k in 'na', 'nc', 'nl', 'anchors', 'stride':
             setattr(self, k, getattr(det, k))
+        self.candidates = TargetCandidates(self.anchors, h['anchor_t'])  # grid candidates of targets
+        self.grid_strides = [int(s) for s in self.stride]
+        self.executor, self.stream = None, None  # find_positive_async() thread and CUDA stream
 
-    def __call__(self, p, targets, imgs):  # predictions, targets, model   
+    def __call__(self, p, targets, imgs, candidates=None):  # predictions, targets, model, find_positive_async() future
         device = targets.device
         lcls, lbox, lobj = torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
-        bs, as_, gjs, gis, targets, anchors = self.build_targets(p, targets, imgs)
+        bs, as_, gjs, gis, targets, anchors = self.build_targets(p, targets, imgs, candidates)
         pre_gen_gains = [torch.tensor(pp.shape, device=device)[[3, 2, 3, 2]] for pp in p] 
     
 
@@ -635,215 +659,138 @@ class ComputeLossOTA:
         loss = lbox + lobj + lcls
         return loss * bs, torch.cat((lbox, lobj, lcls, loss)).detach()
 
-    def build_targets(self, p, targets, imgs):
-        
+    def build_targets(self, p, targets, imgs, candidates=None):
+        # SimOTA assignment for the whole batch at once, GTs and candidates padded per image to (bs, G, N) pairs
         #indices, anch = self.find_positive(p, targets)
-        indices, anch = self.find_3_positive(p, targets)
+        indices, anch = self.find_3_positive(p, targets) if candidates is None else candidates.result()
         #indices, anch = self.find_4_positive(p, targets)
         #indices, anch = self.find_5_positive(p, targets)
         #indices, anch = self.find_9_positive(p, targets)
-        device = torch.device(targets.device)
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
-        nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
+        device = targets.device
+        nl, bs = len(p), p[0].shape[0]
 
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
-            
+        with torch.no_grad():
+            # Candidates of all layers, decoded to image-space boxes
+            pxyxys, p_cls, p_obj, from_which_layer = [], [], [], []
             for i, pi in enumerate(p):
-                
                 b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append((torch.ones(size=(len(b),)) * i).to(device))
-                
-                fg_pred = pi[b, a, gj, gi]                
+                fg_pred = pi[b, a, gj, gi]
                 p_obj.append(fg_pred[:, 4:5])
                 p_cls.append(fg_pred[:, 5:])
-                
+
                 grid = torch.stack([gi, gj], dim=1)
                 pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
-                pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pxywh = torch.cat([pxy, pwh], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
-            
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(10, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost, device=device)
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = (matching_matrix.sum(0) > 0.0).to(device)
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
-
-        for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
+                pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i] * self.stride[i] #/ 8.
+                pxyxys.append(xywh2xyxy(torch.cat([pxy, pwh], dim=-1)))
+                from_which_layer.append(torch.full_like(b, i))
+
+            # Group candidates and GTs by image, keeping their order within each image
+            all_b, all_a, all_gj, all_gi = (torch.cat(x, 0) for x in zip(*indices))
+            order = stable_argsort(all_b)
+            all_b, all_a, all_gj, all_gi = all_b[order], all_a[order], all_gj[order], all_gi[order]
+            all_anch, from_which_layer = torch.cat(anch, 0)[order], torch.cat(from_which_layer, 0)[order]
+            pxyxys, p_cls, p_obj = torch.cat(pxyxys, 0)[order], torch.cat(p_cls, 0)[order], torch.cat(p_obj, 0)[order]
+            gt_order = stable_argsort(targets[:, 0].long())
+            this_target = targets[gt_order]
+            gt_b = this_target[:, 0].long()
+
+            matching = [[] for _ in range(6)]  # b, a, gj, gi, targets, anchors per layer
+            if len(all_b):
+                # Pad to (bs, G) GTs and (bs, N) candidates
+                n_gt, n_c = torch.bincount(gt_b, minlength=bs), torch.bincount(all_b, minlength=bs)
+                G, N = int(n_gt.max()), int(n_c.max())
+                gt_idx = torch.full((bs, G), -1, device=device, dtype=torch.long)
+                gt_idx[gt_b, rank_in_segments(n_gt)] = torch.arange(len(gt_b), device=device)
+                c_idx = torch.full((bs, N), -1, device=device, dtype=torch.long)
+                c_idx[all_b, rank_in_segments(n_c)] = torch.arange(len(all_b), device=device)
+                gt_mask, c_mask = gt_idx >= 0, c_idx >= 0
+                pair_mask = gt_mask[:, :, None] & c_mask[:, None, :]
+
+                txyxy = xywh2xyxy(this_target[:, 2:6] * imgs.shape[2])[gt_idx.clamp(0)]  # (bs, G, 4)
+                pxyxy = pxyxys.float()[c_idx.clamp(0)]  # (bs, N, 4)
+
+                # IoU cost, as box_iou() on each (bs, G, N) pair
+                area1 = (txyxy[..., 2] - txyxy[..., 0]) * (txyxy[..., 3] - txyxy[..., 1])
+                area2 = (pxyxy[..., 2] - pxyxy[..., 0]) * (pxyxy[..., 3] - pxyxy[..., 1])
+                inter = (torch.min(txyxy[:, :, None, 2], pxyxy[:, None, :, 2]) -
+                         torch.max(txyxy[:, :, None, 0], pxyxy[:, None, :, 0])).clamp(0) * \
+                        (torch.min(txyxy[:, :, None, 3], pxyxy[:, None, :, 3]) -
+                         torch.max(txyxy[:, :, None, 1], pxyxy[:, None, :, 1])).clamp(0)
+                pair_wise_iou = (inter / (area1[:, :, None] + area2[:, None, :] - inter)).masked_fill_(~pair_mask, 0.)
+                pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
+
+                top_k, _ = torch.topk(pair_wise_iou, min(10, N), dim=2)
+                dynamic_ks = torch.clamp(top_k.sum(2).int(), min=1)  # (bs, G)
+
+                gt_cls = this_target[:, 1].long()[gt_idx.clamp(0)]  # (bs, G)
+                pair_wise_cls_loss = ota_cls_cost(p_cls[c_idx.clamp(0)], p_obj[c_idx.clamp(0)], gt_cls)
+
+                cost = (pair_wise_cls_loss + 3.0 * pair_wise_iou_loss).masked_fill_(~pair_mask, float('inf'))
+
+                # Dynamic k lowest-cost candidates per GT. The same (b, a, gj, gi) can be a candidate of several GTs and
+                # its duplicates have equal costs, so crowded images may break such ties differently from the former
+                # per-image loop and match a few different positives
+                _, pos_idx = torch.topk(cost, min(10, N), dim=2, largest=False)
+                in_k = torch.arange(pos_idx.shape[2], device=device) < dynamic_ks[..., None]  # (bs, G, k)
+                matching_matrix = torch.zeros_like(cost, dtype=torch.bool).scatter_(2, pos_idx, in_k)
+                matching_matrix &= pair_mask
+
+                # Candidates matched to several GTs go to the lowest-cost GT
+                conflict = matching_matrix.sum(1) > 1  # (bs, N)
+                cost_argmin = cost.argmin(1)
+                matching_matrix = torch.where(conflict[:, None, :],
+                                              torch.arange(G, device=device)[:, None] == cost_argmin[:, None, :],
+                                              matching_matrix)
+                fg_b, fg_n = matching_matrix.any(1).nonzero(as_tuple=True)  # by image, then candidate order
+                matched_gt_inds = gt_idx[fg_b, matching_matrix[fg_b, :, fg_n].float().argmax(1)]
+                fg = c_idx[fg_b, fg_n]
+
+                layer = from_which_layer[fg]
+                for i in range(nl):
+                    j = layer == i
+                    k = fg[j]
+                    for m, x in zip(matching, (all_b[k], all_a[k], all_gj[k], all_gi[k],
+                                               this_target[matched_gt_inds[j]], all_anch[k])):
+                        m.append(x)
             else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs           
+                for m, x in zip(matching, (all_b, all_a, all_gj, all_gi, this_target[:0], torch.cat(anch, 0))):
+                    m.extend([x[:0]] * nl)
+
+        return matching
+
+    def find_positive_async(self, targets, imgs):
+        # Start find_3_positive(), which depends only on the targets and the grid shapes, in a background thread (on a
+        # side CUDA stream) so it overlaps the forward pass. Pass the returned future to __call__(candidates=...)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(1)
+        shapes = [(imgs.shape[2] // s, imgs.shape[3] // s) for s in self.grid_strides]  # grid (ny, nx) per layer
+        if not targets.is_cuda:
+            return self.executor.submit(self.candidates.positives, shapes, targets)
+
+        main = torch.cuda.current_stream(targets.device)
+        self.stream = self.stream or torch.cuda.Stream(targets.device)
+        self.stream.wait_stream(main)  # targets copied to the device
+        targets.record_stream(self.stream)
+
+        def run():
+            with torch.cuda.device(targets.device), torch.cuda.stream(self.stream):
+                indices, anch = self.candidates.positives(shapes, targets)
+            main.wait_stream(self.stream)
+            for x in [*anch, *(y for x in indices for y in x)]:
+                x.record_stream(main)  # allocated on the side stream, used on the main one
+            return indices, anch
+
+        return self.executor.submit(run)
+
+    def close(self):
+        # Shut down the find_positive_async() thread
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
     def find_3_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
-        na, nt = self.na, targets.shape[0]  # number of anchors, targets
-        indices, anch = [], []
-        gain = torch.ones(7, device=targets.device).long()  # normalized to gridspace gain
-        ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
-        targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
-
-        g = 0.5  # bias
-        off = torch.tensor([[0, 0],
-                            [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
-                            # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-                            ], device=targets.device).float() * g  # offsets
-
-        for i in range(self.nl):
-            anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain
-            if nt:
-                # Matches
-                r = t[:, :, 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1. / r).max(2)[0] < self.hyp['anchor_t']  # compare
-                # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1. < g) & (gxy > 1.)).T
-                l, m = ((gxi % 1. < g) & (gxi > 1.)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            b, c = t[:, :2].long().T  # image, class
-            gxy = t[:, 2:4]  # grid xy
-            gwh = t[:, 4:6]  # grid wh
-            gij = (gxy - offsets).long()
-            gi, gj = gij.T  # grid xy indices
-
-            # Append
-            a = t[:, 6].long()  # anchor indices
-            indices.append((b, a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1)))  # image, anchor, grid indices
-            anch.append(anchors[a])  # anchors
-
-        return indices, anch
+        return self.candidates.positives([pi.shape[2:4] for pi in p], targets)
     
 
 class ComputeLossBinOTA:
@@ -872,6 +819,7 @@ class ComputeLossBinOTA:
         self.BCEcls, self.BCEobj, self.gr, self.hyp, self.autobalance = BCEcls, BCEobj, model.gr, h, autobalance
         for k in 'na', 'nc', 'nl', 'anchors', 'stride', 'bin_count':
             setattr(self, k, getattr(det, k))
+        self.candidates = TargetCandidates(self.anchors, h['anchor_t'])  # grid candidates of targets
 
         #xy_bin_sigmoid = SigmoidBin(bin_count=11, min=-0.5, max=1.5, use_loss_regression=False).to(device)
         wh_bin_sigmoid = SigmoidBin(bin_count=self.bin_count, min=0.0, max=4.0, use_loss_regression=False).to(device)
@@ -1042,24 +990,8 @@ class ComputeLossBinOTA:
             top_k, _ = torch.topk(pair_wise_iou, min(10, pair_wise_iou.shape[1]), dim=1)
             dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
 
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]            
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
+            num_gt = this_target.shape[0]
+            pair_wise_cls_loss = ota_cls_cost(p_cls, p_obj, this_target[:, 1].long())
         
             cost = (
                 pair_wise_cls_loss
@@ -1110,67 +1042,18 @@ class ComputeLossBinOTA:
                 matching_targets[i] = torch.cat(matching_targets[i], dim=0)
                 matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
             else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
+                matching_bs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_as[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gjs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gis[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_targets[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_anchs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
 
         return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs       
 
     def find_3_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
-        na, nt = self.na, targets.shape[0]  # number of anchors, targets
-        indices, anch = [], []
-        gain = torch.ones(7, device=targets.device).long()  # normalized to gridspace gain
-        ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
-        targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
-
-        g = 0.5  # bias
-        off = torch.tensor([[0, 0],
-                            [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
-                            # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-                            ], device=targets.device).float() * g  # offsets
-
-        for i in range(self.nl):
-            anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain
-            if nt:
-                # Matches
-                r = t[:, :, 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1. / r).max(2)[0] < self.hyp['anchor_t']  # compare
-                # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1. < g) & (gxy > 1.)).T
-                l, m = ((gxi % 1. < g) & (gxi > 1.)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            b, c = t[:, :2].long().T  # image, class
-            gxy = t[:, 2:4]  # grid xy
-            gwh = t[:, 4:6]  # grid wh
-            gij = (gxy - offsets).long()
-            gi, gj = gij.T  # grid xy indices
-
-            # Append
-            a = t[:, 6].long()  # anchor indices
-            indices.append((b, a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1)))  # image, anchor, grid indices
-            anch.append(anchors[a])  # anchors
-
-        return indices, anch
+        return self.candidates.positives([pi.shape[2:4] for pi in p], targets)
 
 
 class ComputeLossAuxOTA:
@@ -1198,6 +1081,8 @@ class ComputeLossAuxOTA:
         self.BCEcls, self.BCEobj, self.gr, self.hyp, self.autobalance = BCEcls, BCEobj, model.gr, h, autobalance
         for k in 'na', 'nc', 'nl', 'anchors', 'stride':
             setattr(self, k, getattr(det, k))
+        self.candidates = TargetCandidates(self.anchors, h['anchor_t'])  # find_3_positive()
+        self.candidates5 = TargetCandidates(self.anchors, h['anchor_t'], g=1.0)  # find_5_positive()
 
     def __call__(self, p, targets, imgs):  # predictions, targets, model   
         device = targets.device
@@ -1360,24 +1245,8 @@ class ComputeLossAuxOTA:
             top_k, _ = torch.topk(pair_wise_iou, min(20, pair_wise_iou.shape[1]), dim=1)
             dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
 
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
             num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
+            pair_wise_cls_loss = ota_cls_cost(p_cls, p_obj, this_target[:, 1].long())
         
             cost = (
                 pair_wise_cls_loss
@@ -1428,12 +1297,12 @@ class ComputeLossAuxOTA:
                 matching_targets[i] = torch.cat(matching_targets[i], dim=0)
                 matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
             else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
+                matching_bs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_as[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gjs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gis[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_targets[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_anchs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
 
         return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs
 
@@ -1513,24 +1382,8 @@ class ComputeLossAuxOTA:
             top_k, _ = torch.topk(pair_wise_iou, min(20, pair_wise_iou.shape[1]), dim=1)
             dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
 
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
             num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
+            pair_wise_cls_loss = ota_cls_cost(p_cls, p_obj, this_target[:, 1].long())
         
             cost = (
                 pair_wise_cls_loss
@@ -1581,117 +1434,84 @@ class ComputeLossAuxOTA:
                 matching_targets[i] = torch.cat(matching_targets[i], dim=0)
                 matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
             else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
+                matching_bs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_as[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gjs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_gis[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_targets[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
+                matching_anchs[i] = torch.tensor([], device=targets.device, dtype=torch.int64)
 
         return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs              
 
     def find_5_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
-        na, nt = self.na, targets.shape[0]  # number of anchors, targets
-        indices, anch = [], []
-        gain = torch.ones(7, device=targets.device).long()  # normalized to gridspace gain
-        ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
-        targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
-
-        g = 1.0  # bias
-        off = torch.tensor([[0, 0],
-                            [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
-                            # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-                            ], device=targets.device).float() * g  # offsets
-
-        for i in range(self.nl):
-            anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain
-            if nt:
-                # Matches
-                r = t[:, :, 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1. / r).max(2)[0] < self.hyp['anchor_t']  # compare
-                # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1. < g) & (gxy > 1.)).T
-                l, m = ((gxi % 1. < g) & (gxi > 1.)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            b, c = t[:, :2].long().T  # image, class
-            gxy = t[:, 2:4]  # grid xy
-            gwh = t[:, 4:6]  # grid wh
-            gij = (gxy - offsets).long()
-            gi, gj = gij.T  # grid xy indices
-
-            # Append
-            a = t[:, 6].long()  # anchor indices
-            indices.append((b, a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1)))  # image, anchor, grid indices
-            anch.append(anchors[a])  # anchors
-
-        return indices, anch                 
+        return self.candidates5.positives([pi.shape[2:4] for pi in p], targets)
 
     def find_3_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
-        na, nt = self.na, targets.shape[0]  # number of anchors, targets
-        indices, anch = [], []
-        gain = torch.ones(7, device=targets.device).long()  # normalized to gridspace gain
-        ai = torch.arange(na, device=targets.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
-        targets = torch.cat((targets.repeat(na, 1, 1), ai[:, :, None]), 2)  # append anchor indices
-
-        g = 0.5  # bias
-        off = torch.tensor([[0, 0],
-                            [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
-                            # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-                            ], device=targets.device).float() * g  # offsets
-
-        for i in range(self.nl):
-            anchors = self.anchors[i]
-            gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain
-            if nt:
-                # Matches
-                r = t[:, :, 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1. / r).max(2)[0] < self.hyp['anchor_t']  # compare
-                # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1. < g) & (gxy > 1.)).T
-                l, m = ((gxi % 1. < g) & (gxi > 1.)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            b, c = t[:, :2].long().T  # image, class
-            gxy = t[:, 2:4]  # grid xy
-            gwh = t[:, 4:6]  # grid wh
-            gij = (gxy - offsets).long()
-            gi, gj = gij.T  # grid xy indices
-
-            # Append
-            a = t[:, 6].long()  # anchor indices
-            indices.append((b, a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1)))  # image, anchor, grid indices
-            anch.append(anchors[a])  # anchors
-
-        return indices, anch
+        return self.candidates.positives([pi.shape[2:4] for pi in p], targets)
+
+
+def profile_loss(cfg='cfg/training/yolov7-tiny.yaml', hyp='data/hyp.scratch.tiny.yaml', batch_size=16, img_size=640,
+                 targets_per_image=(10, 100, 500), device='cpu', runs=5):
+    # Time a ComputeLoss and ComputeLossOTA step (loss and backward to the predictions) for a range of label counts
+    # Usage: from utils.loss import *; profile_loss(device='cpu')
+    import yaml
+    from models.yolo import Model
+    from utils.torch_utils import select_device, time_synchronized
+    device = select_device(device, batch_size=batch_size)
+    with open(hyp) as f:
+        hyp = yaml.load(f, Loader=yaml.SafeLoader)
+    torch.manual_seed(0)
+    model = Model(cfg, ch=3, nc=80).to(device)
+    model.hyp, model.gr, model.nc = hyp, 1.0, 80
+    imgs = torch.zeros(batch_size, 3, img_size, img_size, device=device)
+    with torch.no_grad():
+        p = [x.detach() for x in model(imgs)]  # fixed predictions, only the loss is timed
+
+    print(f"{'targets/img':>12s}{'ComputeLoss (ms)':>20s}{'ComputeLossOTA (ms)':>22s}")
+    for n in targets_per_image:
+        b = torch.arange(batch_size - 1, device=device).repeat_interleave(n)[:, None].float()  # last image unlabelled
+        targets = torch.cat((b, torch.randint(0, 80, b.shape, device=device).float(),
+                             torch.rand(len(b), 2, device=device) * 0.8 + 0.1,
+                             torch.rand(len(b), 2, device=device) * 0.2 + 0.01), 1)  # image, class, xywh
+        dt = [0.0, 0.0]
+        for j, (loss, args) in enumerate(((ComputeLoss(model), ()), (ComputeLossOTA(model), (imgs,)))):
+            for k in range(runs + 1):  # first run is warmup
+                pi = [x.clone().requires_grad_() for x in p]
+                t = time_synchronized()
+                loss(pi, targets, *args)[0].backward()
+                dt[j] += (time_synchronized() - t) * 1E3 / runs if k else 0.0
+        print(f'{n:12d}{dt[0]:20.1f}{dt[1]:22.1f}')
+
+
+def profile_build_targets(cfg='cfg/training/yolov7.yaml', hyp='data/hyp.scratch.p5.yaml', batch_size=16, img_size=640,
+                          targets_per_batch=(10, 100, 1000, 10000), device='', runs=20):
+    # Time the anchor-candidate search, ComputeLoss.build_targets() and ComputeLossOTA.find_3_positive(), per label count
+    # Usage: from utils.loss import *; profile_build_targets()
+    import yaml
+    from models.yolo import Model
+    from utils.torch_utils import select_device, time_synchronized
+    device = select_device(device, batch_size=batch_size)
+    with open(hyp) as f:
+        hyp = yaml.load(f, Loader=yaml.SafeLoader)
+    torch.manual_seed(0)
+    model = Model(cfg, ch=3, nc=80).to(device)
+    model.hyp, model.gr, model.nc = hyp, 1.0, 80
+    s = [int(x) for x in model.stride]
+    p = [torch.zeros(batch_size, model.model[-1].na, img_size // x, img_size // x, 85, device=device) for x in s]
+
+    print(f"{'targets':>10s}{'build_targets (ms)':>22s}{'find_3_positive (ms)':>24s}")
+    for n in targets_per_batch:
+        targets = torch.cat((torch.randint(0, batch_size, (n, 1), device=device).float(),
+                             torch.randint(0, 80, (n, 1), device=device).float(),
+                             torch.rand(n, 2, device=device),
+                             torch.rand(n, 2, device=device) * 0.5 + 0.001), 1)  # image, class, xywh
+        dt = []
+        for f in ComputeLoss(model).build_targets, ComputeLossOTA(model).find_3_positive:
+            f(p, targets)  # warmup, gain cache
+            t = time_synchronized()
+            for _ in range(runs):
+                f(p, targets)
+            dt.append((time_synchronized() - t) * 1E3 / runs)
+        print(f'{n:10d}{dt[0]:22.2f}{dt[1]:24.2f}')